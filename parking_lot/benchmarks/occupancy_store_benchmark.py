@@ -0,0 +1,76 @@
+"""Benchmark OccupancyStore writes and range analytics on months of synthetic status changes.
+
+Run from the parking_lot directory: python -m benchmarks.occupancy_store_benchmark
+"""
+import numpy as np
+import tempfile
+import time
+from occupancy_store import OccupancyStore
+
+DAY = 24 * 3600
+
+
+def synthetic_changes(spaces, days, seed=0):
+    """Yield (time, space, status) with cars arriving mostly during the day and staying about an hour"""
+    rng = np.random.default_rng(seed)
+    start = 1700000000 // DAY * DAY
+    for day in range(days):
+        arrivals = rng.poisson(6, spaces)
+        owners = np.repeat(np.arange(spaces), arrivals)
+        arrive = start + day * DAY + np.clip(rng.normal(13, 3, len(owners)), 0, 23) * 3600
+        leave = arrive + rng.exponential(3600, len(owners))
+        times = np.concatenate([arrive, leave])
+        statuses = np.concatenate([np.ones(len(owners), bool), np.zeros(len(owners), bool)])
+        owners = np.concatenate([owners, owners])
+
+        # Keep each space's changes alternating, dropping overlapping stays
+        order = np.lexsort((times, owners))
+        last = {}
+        day_changes = []
+        for t, space, status in zip(times[order], owners[order], statuses[order]):
+            if last.get(space, False) != status and t < start + (day + 1) * DAY:
+                last[space] = status
+                day_changes.append((t, int(space), bool(status)))
+        for space, status in last.items():
+            if status:
+                day_changes.append((start + (day + 1) * DAY - 1, int(space), False))
+        day_changes.sort()
+        yield from day_changes
+
+
+def timed(label, function, repeat=5):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    print(f"  {label:<32} {(time.perf_counter() - start) / repeat * 1000:8.2f} ms")
+    return result
+
+
+def run(spaces, days):
+    with tempfile.TemporaryDirectory() as path:
+        store = OccupancyStore(path, range(spaces))
+        start = time.perf_counter()
+        changes = 0
+        for t, space, status in synthetic_changes(spaces, days):
+            store.record(t, space, status)
+            changes += 1
+        store.close()
+        write_time = time.perf_counter() - start
+
+        first = store.chunks[0]
+        last = store.chunks[-1] + DAY
+        print(f"{spaces} spaces, {days} days, {changes} changes, {len(store.chunks)} chunks, "
+              f"written in {write_time:.1f} s")
+
+        store = OccupancyStore(path, range(spaces))
+        middle = first + days // 2 * DAY + 15 * 3600
+        timed("occupancy at T", lambda: store.occupancy_at(middle))
+        timed("dwell times, one day", lambda: store.dwell_times(middle - DAY, middle))
+        timed("dwell times, one week", lambda: store.dwell_times(middle - 7 * DAY, middle))
+        timed("turnover, whole history", lambda: store.turnover(first, last), repeat=1)
+        timed("hourly profile, one month", lambda: store.hourly_profile(middle - 30 * DAY, middle), repeat=1)
+
+
+if __name__ == "__main__":
+    run(200, 90)
+    run(1000, 90)
@@ -0,0 +1,59 @@
+"""Benchmark the per-frame cost and accuracy of CameraStabilizer against frame preprocessing.
+
+Run from the parking_lot directory: python -m benchmarks.stabilizer_benchmark
+"""
+import cv2 as open_cv
+import numpy as np
+import time
+from motion_detector import MotionDetector
+from stabilizer import CameraStabilizer
+
+
+def shaken_frames(image, count, amplitude=6, seed=0):
+    """Yield (frame, dx, dy) with the image moved by a random jitter, like a pole camera in wind"""
+    rng = np.random.default_rng(seed)
+    height, width = image.shape[:2]
+    for _ in range(count):
+        dx, dy = rng.integers(-amplitude, amplitude + 1, 2)
+        matrix = np.float32([[1, 0, dx], [0, 1, dy]])
+        yield open_cv.warpAffine(image, matrix, (width, height), borderMode=open_cv.BORDER_REPLICATE), dx, dy
+
+
+def run(image, label, frames=200):
+    grayed_frames = []
+    for frame, dx, dy in shaken_frames(image, frames):
+        grayed_frames.append((MotionDetector.preprocess(frame), dx, dy))
+
+    start = time.perf_counter()
+    for frame, _, _ in shaken_frames(image, frames):
+        MotionDetector.preprocess(frame)
+    preprocess_time = (time.perf_counter() - start) / frames
+
+    stabilizer = CameraStabilizer()
+    stabilizer.set_reference(MotionDetector.preprocess(image))
+    start = time.perf_counter()
+    for grayed, _, _ in grayed_frames:
+        stabilizer.update(grayed)
+    cached_time = (time.perf_counter() - start) / frames
+
+    # Estimate on every frame to measure accuracy and the cost of a single estimate
+    stabilizer = CameraStabilizer(update_every=1)
+    stabilizer.set_reference(MotionDetector.preprocess(image))
+    errors = []
+    start = time.perf_counter()
+    for grayed, dx, dy in grayed_frames:
+        shift = stabilizer.update(grayed)
+        errors.append(max(abs(shift[0] - dx), abs(shift[1] - dy)))
+    estimate_time = (time.perf_counter() - start) / frames
+
+    print(f"{label}: preprocess {preprocess_time * 1000:.2f} ms/frame, "
+          f"stabilizer {cached_time * 1000:.3f} ms/frame (every {CameraStabilizer.UPDATE_EVERY} frames), "
+          f"single estimate {estimate_time * 1000:.2f} ms, "
+          f"max error {max(errors)} px, mean error {np.mean(errors):.2f} px")
+
+
+if __name__ == "__main__":
+    image = open_cv.imread("images/parking_lot_1.png")
+    run(image, f"{image.shape[1]}x{image.shape[0]}")
+    run(open_cv.resize(image, (1920, 1080)), "1920x1080")
+    run(open_cv.resize(image, (3840, 2160)), "3840x2160", frames=50)
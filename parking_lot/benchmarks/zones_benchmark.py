@@ -0,0 +1,66 @@
+"""Benchmark nearest-vacant-space queries of ParkingIndex against a linear scan.
+
+Run from the parking_lot directory: python -m benchmarks.zones_benchmark
+"""
+import numpy as np
+import time
+from zones import ParkingIndex
+
+
+def synthetic_lot(spaces, seed=0):
+    """Lay out spaces as 20x40 pixel stalls in rows, tagged with zones and levels"""
+    rng = np.random.default_rng(seed)
+    columns = int(np.sqrt(spaces * 2))
+    coordinates_data = []
+    for space_id in range(spaces):
+        x = (space_id % columns) * 24 + int(rng.integers(0, 4))
+        y = (space_id // columns) * 48 + int(rng.integers(0, 4))
+        coordinates_data.append({
+            "id": space_id,
+            "zone": chr(ord("A") + (space_id % columns) * 4 // columns),
+            "level": space_id * 3 // spaces,
+            "coordinates": [[x, y], [x + 20, y], [x + 20, y + 40], [x, y + 40]],
+        })
+    return coordinates_data
+
+
+def linear_nearest(index, point):
+    vacant = np.flatnonzero(~np.array(index.statuses))
+    distances = np.hypot(*(index.centroids[vacant] - point).T)
+    return index.ids[vacant[np.argmin(distances)]]
+
+
+def run(spaces, occupancy, queries=2000):
+    rng = np.random.default_rng(1)
+    index = ParkingIndex(synthetic_lot(spaces))
+    for space in np.flatnonzero(rng.random(spaces) < occupancy):
+        index.set_status(int(space), True)
+
+    high = index.centroids.max(axis=0)
+    points = rng.random((queries, 2)) * high
+
+    start = time.perf_counter()
+    results = [index.nearest_vacant(tuple(point))[0][1] for point in points]
+    grid_time = (time.perf_counter() - start) / queries
+
+    start = time.perf_counter()
+    expected = [linear_nearest(index, point) for point in points[:200]]
+    linear_time = (time.perf_counter() - start) / 200
+
+    assert all(index.centroids[a].tolist() == index.centroids[b].tolist() or a == b
+               for a, b in zip(results, expected))
+
+    start = time.perf_counter()
+    for space in rng.integers(0, spaces, queries):
+        index.set_status(int(space), not index.statuses[space])
+    update_time = (time.perf_counter() - start) / queries
+
+    print(f"{spaces:>7} spaces, {occupancy:.1%} occupied: "
+          f"grid query {grid_time * 1e6:8.1f} us, linear scan {linear_time * 1e6:8.1f} us, "
+          f"status update {update_time * 1e6:6.1f} us")
+
+
+if __name__ == "__main__":
+    for spaces in (10000, 50000, 100000):
+        for occupancy in (0.5, 0.95, 0.999):
+            run(spaces, occupancy)
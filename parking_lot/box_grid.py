@@ -0,0 +1,40 @@
+class BoxGrid:
+    """Uniform grid over bounding boxes, for finding the shapes that overlap a point or a rectangle"""
+
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self.cells = {}  # (column, row) -> set of keys
+        self.boxes = {}  # key -> (x, y, width, height)
+
+    def _cells(self, box):
+        x, y, width, height = box
+        for column in range(x // self.cell_size, (x + max(width, 1) - 1) // self.cell_size + 1):
+            for row in range(y // self.cell_size, (y + max(height, 1) - 1) // self.cell_size + 1):
+                yield column, row
+
+    def add(self, key, box):
+        self.boxes[key] = box
+        for cell in self._cells(box):
+            self.cells.setdefault(cell, set()).add(key)
+
+    def remove(self, key):
+        for cell in self._cells(self.boxes.pop(key)):
+            members = self.cells[cell]
+            members.discard(key)
+            if not members:
+                del self.cells[cell]
+
+    def query(self, box):
+        """Return the keys whose boxes intersect the given box"""
+        x, y, width, height = box
+        found = set()
+        for cell in self._cells(box):
+            for key in self.cells.get(cell, ()):
+                bx, by, bw, bh = self.boxes[key]
+                if bx < x + width and x < bx + bw and by < y + height and y < by + bh:
+                    found.add(key)
+        return found
+
+    def at(self, x, y):
+        """Return the keys whose boxes contain the given point"""
+        return self.query((x, y, 1, 1))
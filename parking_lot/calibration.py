@@ -0,0 +1,265 @@
+import argparse
+import hashlib
+import logging
+import os
+import time
+import numpy as np
+import yaml
+from motion_detector import MotionDetector
+
+DIFF_THRESHOLDS = np.arange(5, 85, 5)  # Candidate gray level thresholds for the changed pixel fraction
+MOTION_WEIGHTS = np.array([0.0, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0])
+DIFF_WEIGHTS = np.array([0.0, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0])
+LABEL_TOLERANCE = 1.0  # Seconds between a labeled time and the nearest cached sample
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+
+    with open(args.data_file, "r") as data:
+        coordinates = yaml.safe_load(data)
+    with open(args.labels_file, "r") as labels:
+        labels = yaml.safe_load(labels)
+
+    features = load_features(args.cache_file, args.video_file, coordinates, int(args.start_frame), int(args.every))
+    if features is None:
+        start = time.perf_counter()
+        features = extract_features(args.video_file, coordinates, int(args.start_frame), int(args.every))
+        save_features(args.cache_file, features)
+        logging.info(f"Cached features of {len(features['positions'])} frames to {args.cache_file} "
+                     f"in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    samples = label_samples(features, labels)
+    calibration = sweep(features, samples, per_space=args.per_space)
+    logging.info(f"Swept {len(DIFF_THRESHOLDS) * len(MOTION_WEIGHTS) * len(DIFF_WEIGHTS)} parameter sets "
+                 f"over {len(samples[0])} labeled samples in {time.perf_counter() - start:.2f}s")
+
+    with open(args.output_file, "w") as output:
+        yaml.safe_dump(calibration, output, sort_keys=False)
+    logging.info(f"Balanced accuracy {calibration['balanced_accuracy']:.3f}, saved to {args.output_file}")
+
+
+def extract_features(video, coordinates, start_frame, every, stabilize=True):
+    """Decode the video once and compute the raw features of every space on every sampled frame"""
+    detector = MotionDetector(video, coordinates, start_frame, stabilize=stabilize)
+    detector._prepare_spaces()
+
+    motion, diff, positions = [], [], []
+    for number, (frame, grayed, position_in_seconds) in enumerate(MotionDetector.read_frames(video, start_frame)):
+        if number == 0:
+            detector._collect_reference_frames(grayed)
+        if detector.stabilizer is not None:
+            detector.shift = detector.stabilizer.update(grayed)
+        if number % every:
+            continue
+
+        frame_motion = np.zeros(len(coordinates), dtype=np.float32)
+        frame_diff = np.zeros((len(coordinates), len(DIFF_THRESHOLDS)), dtype=np.float32)
+        for index in range(len(coordinates)):
+            roi_gray = detector._roi(grayed, index)
+            frame_motion[index], frame_diff[index] = detector._space_features(roi_gray, index, DIFF_THRESHOLDS)
+        motion.append(frame_motion)
+        diff.append(frame_diff)
+        positions.append(position_in_seconds)
+
+    return {
+        "video": os.path.abspath(video),
+        "start_frame": start_frame,
+        "every": every,
+        "space_ids": np.array([p["id"] for p in coordinates]),
+        "space_hashes": space_hashes(coordinates),
+        "skip_frames": MotionDetector.SKIP_FRAMES,
+        "stabilize": stabilize,
+        "thresholds": DIFF_THRESHOLDS,
+        "positions": np.array(positions, dtype=np.float64),
+        "motion": np.array(motion, dtype=np.float32).reshape(-1, len(coordinates)),
+        "diff": np.array(diff, dtype=np.float32).reshape(-1, len(coordinates), len(DIFF_THRESHOLDS)),
+    }
+
+
+def space_hashes(coordinates):
+    """Fingerprint the outline of every space, so moving a space invalidates its cached features"""
+    return np.array([hashlib.sha1(np.array(p["coordinates"], dtype=np.int64).tobytes()).hexdigest()
+                     for p in coordinates])
+
+
+def save_features(path, features):
+    np.savez_compressed(path, **features)
+
+
+def load_features(path, video, coordinates, start_frame, every, stabilize=True):
+    """Return the cached features if they were computed for the same video, spaces, sampling and settings"""
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as cache:
+        features = {key: cache[key] for key in cache.files}
+
+    if (any(key not in features for key in ("space_hashes", "skip_frames", "stabilize"))
+            or str(features["video"]) != os.path.abspath(video)
+            or int(features["start_frame"]) != start_frame
+            or int(features["every"]) != every
+            or features["space_ids"].tolist() != [p["id"] for p in coordinates]
+            or features["space_hashes"].tolist() != space_hashes(coordinates).tolist()
+            or int(features["skip_frames"]) != MotionDetector.SKIP_FRAMES
+            or bool(features["stabilize"]) != stabilize
+            or features["thresholds"].tolist() != DIFF_THRESHOLDS.tolist()):
+        logging.info(f"Cache {path} does not match the video, spaces, sampling or settings, decoding again")
+        return None
+    logging.info(f"Using cached features of {len(features['positions'])} frames from {path}")
+    return features
+
+
+def label_samples(features, labels):
+    """Turn labels into (frame, space, occupied) arrays indexing the cached features.
+
+    Each label gives a video time and the ids of the occupied spaces; spaces listed under
+    "vacant" are the only vacant ones when given, otherwise every other space is vacant.
+    """
+    positions = features["positions"]
+    space_indexes = {int(space_id): index for index, space_id in enumerate(features["space_ids"])}
+    frames, spaces, occupied = [], [], []
+
+    for label in labels:
+        frame = int(np.argmin(np.abs(positions - label["time"]))) if len(positions) else None
+        if frame is None or abs(positions[frame] - label["time"]) > LABEL_TOLERANCE:
+            logging.warning(f"No sampled frame near {label['time']}s, skipping label")
+            continue
+
+        taken = set(label.get("occupied") or [])
+        free = set(label["vacant"]) if "vacant" in label else set(space_indexes) - taken
+        for space_id in taken | free:
+            if space_id not in space_indexes:
+                logging.warning(f"Unknown space id {space_id} in label at {label['time']}s")
+                continue
+            frames.append(frame)
+            spaces.append(space_indexes[space_id])
+            occupied.append(space_id in taken)
+
+    return np.array(frames, dtype=int), np.array(spaces, dtype=int), np.array(occupied, dtype=bool)
+
+
+def best_cuts(scores, occupied):
+    """Find, for every row of scores, the threshold that best separates occupied from vacant samples.
+
+    Returns (balanced accuracy, threshold) arrays; scores above the threshold mean occupied.
+    """
+    order = np.argsort(scores, axis=-1, kind="stable")
+    ranked = np.take_along_axis(scores, order, axis=-1)
+    positives = occupied[order]
+
+    total_positive = max(int(occupied.sum()), 1)
+    total_negative = max(int((~occupied).sum()), 1)
+    # Cutting before sample k marks samples [0, k) vacant and [k, n) occupied
+    zeros = np.zeros(scores.shape[:-1] + (1,))
+    true_negative = np.concatenate([zeros, np.cumsum(~positives, axis=-1)], axis=-1)
+    true_positive = total_positive - np.concatenate([zeros, np.cumsum(positives, axis=-1)], axis=-1)
+    accuracy = (true_negative / total_negative + true_positive / total_positive) / 2
+
+    # A cut between two equal scores cannot be expressed as a threshold
+    accuracy[..., 1:-1][ranked[..., 1:] == ranked[..., :-1]] = -1
+    cut = np.argmax(accuracy, axis=-1)
+
+    padded = np.concatenate([ranked[..., :1] - 1, ranked, ranked[..., -1:] + 1], axis=-1)
+    below = np.take_along_axis(padded, cut[..., None], axis=-1)[..., 0]
+    above = np.take_along_axis(padded, cut[..., None] + 1, axis=-1)[..., 0]
+    return np.take_along_axis(accuracy, cut[..., None], axis=-1)[..., 0], (below + above) / 2
+
+
+def sweep(features, samples, per_space=False):
+    """Try every threshold and weight combination on the labeled samples and keep the best"""
+    frames, spaces, occupied = samples
+    if len(frames) == 0:
+        raise ValueError("No labeled samples match the cached frames")
+    if occupied.all() or not occupied.any():
+        raise ValueError("Labels must include both occupied and vacant samples")
+
+    motion = features["motion"][frames, spaces].astype(np.float64)  # (samples,)
+    diff = features["diff"][frames, spaces].astype(np.float64).T  # (thresholds, samples)
+
+    best = None
+    for t in range(len(DIFF_THRESHOLDS)):
+        # Combined metric for every (motion weight, diff weight) of this threshold at once
+        scores = MOTION_WEIGHTS[:, None, None] * motion + DIFF_WEIGHTS[None, :, None] * diff[t]
+        accuracy, cuts = best_cuts(scores, occupied)
+        # On ties, the first best combination in sweep order wins
+        m, d = np.unravel_index(np.argmax(accuracy), accuracy.shape)
+        if best is None or accuracy[m, d] > best[0]:
+            best = (accuracy[m, d], cuts[m, d], t, m, d, scores[m, d])
+    accuracy, cut, t, m, d, scores = best
+
+    calibration = {
+        "diff_threshold": int(DIFF_THRESHOLDS[t]),
+        "motion_weight": float(MOTION_WEIGHTS[m]),
+        "diff_weight": float(DIFF_WEIGHTS[d]),
+        "sensitivity": round(float(cut), 4),
+        "balanced_accuracy": round(float(accuracy), 4),
+    }
+
+    if per_space:
+        overrides = {}
+        for index in np.unique(spaces):
+            selected = spaces == index
+            # Only spaces seen both occupied and vacant say anything about their own threshold
+            if occupied[selected].all() or not occupied[selected].any():
+                continue
+            _, cut = best_cuts(scores[selected], occupied[selected])
+            overrides[int(features["space_ids"][index])] = round(float(cut), 4)
+        calibration["spaces"] = overrides
+
+    return calibration
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Parking Lot Sensitivity Calibration')
+
+    parser.add_argument("--video",
+                        dest="video_file",
+                        required=True,
+                        help="Recording to calibrate on")
+
+    parser.add_argument("--data",
+                        dest="data_file",
+                        required=True,
+                        help="Data file with the parking space coordinates")
+
+    parser.add_argument("--labels",
+                        dest="labels_file",
+                        required=True,
+                        help="YAML list of {time, occupied[, vacant]} labels")
+
+    parser.add_argument("--cache",
+                        dest="cache_file",
+                        required=False,
+                        default="features.npz",
+                        help="Where to cache the per-space features of the recording")
+
+    parser.add_argument("--output",
+                        dest="output_file",
+                        required=False,
+                        default="calibration.yml",
+                        help="Calibration file to write, to be used with main.py --calibration")
+
+    parser.add_argument("--start-frame",
+                        dest="start_frame",
+                        required=False,
+                        default=1,
+                        help="Starting frame on the video")
+
+    parser.add_argument("--every",
+                        dest="every",
+                        required=False,
+                        default=5,
+                        help="Cache features of every n-th frame")
+
+    parser.add_argument("--per-space",
+                        dest="per_space",
+                        action="store_true",
+                        help="Also find a sensitivity for each space with both kinds of labels")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,15 +2,28 @@ import cv2 as open_cv
 import numpy as np
 import os
 import sys
+import yaml
 
 from colors import COLOR_WHITE, COLOR_RED, COLOR_GREEN, COLOR_BLUE
 from drawing_utils import draw_contours
+from box_grid import BoxGrid
 
 
 class CoordinatesGenerator:
     KEY_RESET = ord("r")
     KEY_QUIT = ord("q")
     KEY_SWITCH_MODE = ord("m")
+    KEY_DELETE = ord("d")
+    KEY_SAVE = ord("s")
+    KEY_ZOOM_IN = (ord("+"), ord("="))
+    KEY_ZOOM_OUT = (ord("-"), ord("_"))
+
+    MODES = ("polygon", "rectangle", "select")
+    MAX_VIEW_SIZE = (1280, 720)  # Largest window shown; bigger images are zoomed out to fit
+    MAX_ZOOM = 8.0
+    ZOOM_STEP = 1.25
+    MARGIN = 16  # Pixels around a space that its border and label can touch
+    PREVIEW_COLOR = (0, 255, 255)
 
     def __init__(self, image, output, color):
         self.output = output
@@ -21,63 +34,58 @@ class CoordinatesGenerator:
         if not os.path.isfile(image):
             print(f"Error: Image file '{image}' not found. Please check the file path.")
             sys.exit(1)
-        
+
         # Load the image and check if it was loaded successfully
-        self.image = open_cv.imread(image)
-        if self.image is None:
+        self.original_image = open_cv.imread(image)
+        if self.original_image is None:
             print(f"Error: Failed to load image file '{image}'. The file might be corrupted or in an unsupported format.")
             sys.exit(1)
-            
-        self.original_image = self.image.copy()  # Keep original image for reset
-        self.temp_image = self.image.copy()  # For drawing temporary shapes
+
+        # Existing spaces, keyed by id, with a grid over their bounding boxes for hit-testing
+        self.spaces = {}
+        self.boxes = BoxGrid()
+        for space in self.__load(output):
+            self.__add_space(space)
+
+        # Layout layer: the image with every space drawn, kept at full resolution
+        self.image = self.original_image.copy()
+        for space in self.spaces.values():
+            self.__draw_space(self.image, space, (0, 0))
+
         self.click_count = 0
-        self.ids = 0
         self.coordinates = []
-        self.drawing_mode = "polygon"  # Default mode: "polygon" or "rectangle"
+        self.drawing_mode = "polygon"  # "polygon", "rectangle" or "select"
         self.current_position = (0, 0)  # To track current mouse position for preview
+        self.selected = None  # Id of the selected space in select mode
+        self.drag_start = None  # Image point where dragging the selected space started
+        self.pan_start = None  # View point and offset where panning started
 
-        # Display instructions on image
-        self.__add_instructions()
+        # View layer: the visible part of the layout, scaled to the window
+        height, width = self.image.shape[:2]
+        self.min_zoom = min(1.0, self.MAX_VIEW_SIZE[0] / width, self.MAX_VIEW_SIZE[1] / height)
+        self.view_size = (max(int(width * self.min_zoom), 1), max(int(height * self.min_zoom), 1))
+        self.zoom = self.min_zoom
+        self.offset = [0.0, 0.0]
+        self.dirty = []  # View rectangles to restore from the view layer before the next present
+        self.overlay_rect = None  # View rectangle covered by the last preview
+        self.__set_view()
 
         open_cv.namedWindow(self.caption, open_cv.WINDOW_GUI_EXPANDED)
         open_cv.setMouseCallback(self.caption, self.__mouse_callback)
 
-    def __add_instructions(self):
-        # Add instructions text on top of the image
-        instructions = [
-            "Instructions:",
-            "- Click to select points",
-            "- Press 'q' to finish current shape",
-            "- Press 'm' to switch between polygon/rectangle mode",
-            "- Press 'r' to reset",
-            f"- Current mode: {self.drawing_mode.upper()}"
-        ]
-        
-        y = 30
-        for text in instructions:
-            open_cv.putText(self.image, text, (10, y), open_cv.FONT_HERSHEY_SIMPLEX, 
-                          0.6, (0, 255, 255), 2)
-            y += 25
-
     def generate(self):
         print("Coordinates Generator Started")
         print("- Click to define parking space corners")
-        print("- Press 'm' to switch between polygon and rectangle modes")
+        print("- Press 'm' to switch between polygon, rectangle and select modes")
+        print("- In select mode, click a space to select it, drag to move it and press 'd' to delete it")
+        print("- Scroll or press '+'/'-' to zoom, drag with the right button to pan")
         print("- Press 'r' to reset current shape")
-        print("- Press 'q' when finished with all spaces")
-        
+        print("- Press 's' to save, 'q' when finished with all spaces")
+
         while True:
-            # Show image with preview shape if needed
-            display_image = self.temp_image.copy()
-            
-            # In rectangle mode, show preview of rectangle while moving mouse
-            if self.drawing_mode == "rectangle" and self.click_count == 1:
-                pt1 = self.coordinates[0]
-                pt2 = self.current_position
-                open_cv.rectangle(display_image, pt1, pt2, (0, 255, 255), 2)
-                
-            open_cv.imshow(self.caption, display_image)
-            key = open_cv.waitKey(1)  # Update more frequently for smooth preview
+            if self.needs_present:
+                self.__present()
+            key = open_cv.waitKey(1)
 
             if key == CoordinatesGenerator.KEY_RESET:
                 self.__reset_current()
@@ -88,51 +96,216 @@ class CoordinatesGenerator:
                     break  # Otherwise, exit the program
             elif key == CoordinatesGenerator.KEY_SWITCH_MODE:
                 self.__switch_mode()
-                
+            elif key == CoordinatesGenerator.KEY_DELETE:
+                self.__delete_selected()
+            elif key == CoordinatesGenerator.KEY_SAVE:
+                self.save()
+            elif key in CoordinatesGenerator.KEY_ZOOM_IN:
+                self.__zoom(self.ZOOM_STEP, (self.view_size[0] // 2, self.view_size[1] // 2))
+            elif key in CoordinatesGenerator.KEY_ZOOM_OUT:
+                self.__zoom(1 / self.ZOOM_STEP, (self.view_size[0] // 2, self.view_size[1] // 2))
+
+        self.save()
         open_cv.destroyWindow(self.caption)
 
+    def save(self):
+        """Write every space to the output file, replacing it atomically"""
+        temporary = f"{self.output}.tmp"
+        with open(temporary, "w") as output:
+            yaml.safe_dump(list(self.spaces.values()), output, default_flow_style=None, sort_keys=False)
+        os.replace(temporary, self.output)
+        print(f"Saved {len(self.spaces)} spaces to {self.output}")
+
+    def __load(self, output):
+        """Read the spaces of an existing data file, if there is one"""
+        if not os.path.isfile(output):
+            return []
+        with open(output, "r") as data:
+            spaces = yaml.safe_load(data) or []
+        print(f"Loaded {len(spaces)} spaces from {output}")
+        return spaces
+
+    def __add_space(self, space):
+        if "id" not in space or space["id"] in self.spaces:
+            space["id"] = max(self.spaces, default=-1) + 1
+        space["coordinates"] = [[int(x), int(y)] for x, y in space["coordinates"]]
+        self.spaces[space["id"]] = space
+        self.boxes.add(space["id"], self.__bounds(space))
+
+    def __remove_space(self, space_id):
+        self.boxes.remove(space_id)
+        return self.spaces.pop(space_id)
+
+    def __bounds(self, space):
+        """Bounding box of everything drawn for a space, border and label included"""
+        x, y, width, height = open_cv.boundingRect(np.array(space["coordinates"], dtype=np.int32))
+        return (x - self.MARGIN, y - self.MARGIN, width + 2 * self.MARGIN, height + 2 * self.MARGIN)
+
+    def __draw_space(self, image, space, origin):
+        coordinates = np.array(space["coordinates"], dtype=np.int32) - origin
+        draw_contours(image, coordinates, str(space["id"] + 1), COLOR_WHITE)
+
+    def __redraw(self, box):
+        """Repaint one region of the layout layer from the original image and the spaces overlapping it"""
+        height, width = self.image.shape[:2]
+        x0, y0 = max(box[0], 0), max(box[1], 0)
+        x1, y1 = min(box[0] + box[2], width), min(box[1] + box[3], height)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        region = self.image[y0:y1, x0:x1]
+        region[:] = self.original_image[y0:y1, x0:x1]
+        for space_id in sorted(self.boxes.query((x0, y0, x1 - x0, y1 - y0))):
+            self.__draw_space(region, self.spaces[space_id], (x0, y0))
+
+        # Rescale just the matching part of the view layer
+        r0, r1 = np.searchsorted(self.rows, [y0, y1])
+        c0, c1 = np.searchsorted(self.columns, [x0, x1])
+        if r0 < r1 and c0 < c1:
+            self.view[r0:r1, c0:c1] = self.image[np.ix_(self.rows[r0:r1], self.columns[c0:c1])]
+            self.dirty.append((c0, r0, c1 - c0, r1 - r0))
+            self.needs_present = True
+
+    def __set_view(self):
+        """Rebuild the view layer after zooming or panning"""
+        height, width = self.image.shape[:2]
+        self.offset[0] = max(min(self.offset[0], width - self.view_size[0] / self.zoom), 0.0)
+        self.offset[1] = max(min(self.offset[1], height - self.view_size[1] / self.zoom), 0.0)
+
+        # Layout pixel shown by each view column and row
+        self.columns = np.minimum((self.offset[0] + (np.arange(self.view_size[0]) + 0.5) / self.zoom).astype(int),
+                                  width - 1)
+        self.rows = np.minimum((self.offset[1] + (np.arange(self.view_size[1]) + 0.5) / self.zoom).astype(int),
+                               height - 1)
+        self.view = self.image[np.ix_(self.rows, self.columns)]
+        self.display = self.view.copy()
+        self.dirty = []
+        self.overlay_rect = None
+        self.needs_present = True
+
+    def __zoom(self, factor, anchor):
+        """Zoom in or out, keeping the image point under the anchor in place"""
+        zoom = min(max(self.zoom * factor, self.min_zoom), self.MAX_ZOOM)
+        point = self.__to_image(*anchor)
+        self.offset = [point[0] - anchor[0] / zoom, point[1] - anchor[1] / zoom]
+        self.zoom = zoom
+        self.__set_view()
+
+    def __to_image(self, x, y):
+        return (int(self.offset[0] + (x + 0.5) / self.zoom), int(self.offset[1] + (y + 0.5) / self.zoom))
+
+    def __to_view(self, points):
+        return ((np.array(points, dtype=np.float64) - self.offset) * self.zoom).astype(np.int32)
+
+    def __present(self):
+        """Restore the dirty parts of the display from the view layer, draw the overlay and show it"""
+        for x, y, width, height in self.dirty + ([self.overlay_rect] if self.overlay_rect else []):
+            self.display[y:y + height, x:x + width] = self.view[y:y + height, x:x + width]
+        self.dirty = []
+
+        self.__add_instructions()
+        self.overlay_rect = self.__draw_overlay()
+        open_cv.imshow(self.caption, self.display)
+        self.needs_present = False
+
+    def __add_instructions(self):
+        # Add instructions text on top of the view
+        instructions = [
+            "Instructions:",
+            "- Click to select points",
+            "- Press 'q' to finish current shape",
+            "- Press 'm' to switch between polygon/rectangle/select mode",
+            "- Press 'd' to delete the selected space",
+            "- Press 'r' to reset",
+            f"- Current mode: {self.drawing_mode.upper()}"
+        ]
+
+        y = 30
+        for text in instructions:
+            open_cv.putText(self.display, text, (10, y), open_cv.FONT_HERSHEY_SIMPLEX,
+                            0.6, (0, 255, 255), 2)
+            y += 25
+
+    def __draw_overlay(self):
+        """Draw the shape in progress or the selected space, returning the view rectangle it covers"""
+        points = []
+        if self.drawing_mode == "select" and self.selected is not None:
+            coordinates = np.array(self.spaces[self.selected]["coordinates"])
+            if self.drag_start is not None:
+                coordinates = coordinates + np.subtract(self.current_position, self.drag_start)
+            points = self.__to_view(coordinates)
+            open_cv.polylines(self.display, [points], True, self.PREVIEW_COLOR, 2)
+        elif self.drawing_mode == "rectangle" and self.click_count == 1:
+            points = self.__to_view([self.coordinates[0], self.current_position])
+            open_cv.rectangle(self.display, tuple(points[0]), tuple(points[1]), self.PREVIEW_COLOR, 2)
+        elif self.click_count > 0:
+            points = self.__to_view(self.coordinates + [self.current_position])
+            # Draw all lines connecting sequential points, up to the cursor
+            open_cv.polylines(self.display, [points], False, (255, 0, 0), 2)
+            # Draw points as small circles
+            for point in points[:-1]:
+                open_cv.circle(self.display, tuple(point), 3, COLOR_RED, -1)
+
+        if len(points) == 0:
+            return None
+        x, y, width, height = open_cv.boundingRect(np.array(points, dtype=np.int32))
+        x0, y0 = max(x - 4, 0), max(y - 4, 0)
+        x1 = min(x + width + 4, self.view_size[0])
+        y1 = min(y + height + 4, self.view_size[1])
+        return (x0, y0, x1 - x0, y1 - y0) if x0 < x1 and y0 < y1 else None
+
     def __switch_mode(self):
-        """Switch between polygon and rectangle drawing modes"""
+        """Cycle between polygon, rectangle and select modes"""
         self.__reset_current()  # Reset current shape
-        if self.drawing_mode == "polygon":
-            self.drawing_mode = "rectangle"
-        else:
-            self.drawing_mode = "polygon"
-            
-        # Update image with new mode info
-        self.image = self.original_image.copy()
-        self.temp_image = self.image.copy()
-        self.__add_instructions()
+        self.selected = None
+        self.drawing_mode = self.MODES[(self.MODES.index(self.drawing_mode) + 1) % len(self.MODES)]
+        self.dirty.append((0, 0, self.view_size[0], 200))  # Instructions panel
+        self.needs_present = True
         print(f"Switched to {self.drawing_mode.upper()} mode")
 
     def __reset_current(self):
         """Reset the current shape being drawn"""
         self.click_count = 0
         self.coordinates = []
-        self.temp_image = self.image.copy()  # Reset temporary image
+        self.drag_start = None
+        self.needs_present = True
         print("Reset current shape")
 
     def __mouse_callback(self, event, x, y, flags, params):
-        self.current_position = (x, y)
-        self.temp_image = self.image.copy()  # Reset temporary image for drawing
-        
-        # Always draw preview in rectangle mode if one point selected
-        if self.drawing_mode == "rectangle" and self.click_count == 1:
-            pt1 = self.coordinates[0]
-            pt2 = self.current_position
-            open_cv.rectangle(self.temp_image, pt1, pt2, (0, 255, 255), 2)
+        if event == open_cv.EVENT_MOUSEWHEEL:
+            self.__zoom(self.ZOOM_STEP if flags > 0 else 1 / self.ZOOM_STEP, (x, y))
+            return
+
+        if event == open_cv.EVENT_RBUTTONDOWN:
+            self.pan_start = (x, y, list(self.offset))
+            return
+        if event == open_cv.EVENT_RBUTTONUP:
+            self.pan_start = None
+            return
+        if event == open_cv.EVENT_MOUSEMOVE and self.pan_start is not None and flags & open_cv.EVENT_FLAG_RBUTTON:
+            start_x, start_y, offset = self.pan_start
+            self.offset = [offset[0] - (x - start_x) / self.zoom, offset[1] - (y - start_y) / self.zoom]
+            self.__set_view()
+            return
+
+        self.current_position = self.__to_image(x, y)
+        self.needs_present = True
+
+        if self.drawing_mode == "select":
+            self.__handle_select(event)
+            return
 
         if event == open_cv.EVENT_LBUTTONDOWN:
-            self.coordinates.append((x, y))
+            self.coordinates.append(self.current_position)
             self.click_count += 1
-            
+
             # Handle based on mode
             if self.drawing_mode == "rectangle" and self.click_count == 2:
                 # For rectangle mode, we only need 2 points (top-left and bottom-right)
                 # Convert to 4 points for consistency
                 x1, y1 = self.coordinates[0]
                 x2, y2 = self.coordinates[1]
-                
+
                 # Create 4 corners from the 2 points
                 self.coordinates = [
                     (min(x1, x2), min(y1, y2)),  # top-left
@@ -141,31 +314,54 @@ class CoordinatesGenerator:
                     (min(x1, x2), max(y1, y2))   # bottom-left
                 ]
                 self.__handle_done()
-                
+
             elif self.drawing_mode == "polygon" and self.click_count >= 4:
                 # In polygon mode, require at least 4 points before allowing completion
                 if flags & open_cv.EVENT_FLAG_CTRLKEY:  # Hold CTRL to auto-complete
                     self.__handle_done()
-                else:
-                    self.__handle_click_progress()
-                    
-            elif self.click_count > 1:
-                self.__handle_click_progress()
-
-        open_cv.imshow(self.caption, self.temp_image)
-
-    def __handle_click_progress(self):
-        """Draw lines between points as they're being added"""
-        # Draw all lines connecting sequential points
-        for i in range(1, len(self.coordinates)):
-            open_cv.line(self.temp_image, 
-                       self.coordinates[i-1], 
-                       self.coordinates[i], 
-                       (255, 0, 0), 2)
-            
-        # Draw points as small circles
-        for point in self.coordinates:
-            open_cv.circle(self.temp_image, point, 3, COLOR_RED, -1)
+
+    def __handle_select(self, event):
+        """Select a space on click, move it by dragging"""
+        if event == open_cv.EVENT_LBUTTONDOWN:
+            self.selected = self.__hit_test(*self.current_position)
+            self.drag_start = self.current_position if self.selected is not None else None
+
+        elif event == open_cv.EVENT_LBUTTONUP and self.drag_start is not None:
+            dx = self.current_position[0] - self.drag_start[0]
+            dy = self.current_position[1] - self.drag_start[1]
+            self.drag_start = None
+
+            # Keep the whole space inside the image, whatever the pointer did outside of it
+            height, width = self.image.shape[:2]
+            points = np.array(self.spaces[self.selected]["coordinates"])
+            dx = int(min(max(dx, -points[:, 0].min()), width - 1 - points[:, 0].max()))
+            dy = int(min(max(dy, -points[:, 1].min()), height - 1 - points[:, 1].max()))
+            if dx or dy:
+                space = self.__remove_space(self.selected)
+                old_bounds = self.__bounds(space)
+                space["coordinates"] = [[x + dx, y + dy] for x, y in space["coordinates"]]
+                self.__add_space(space)
+                self.__redraw(old_bounds)
+                self.__redraw(self.__bounds(space))
+                print(f"Moved space #{space['id'] + 1}")
+
+    def __hit_test(self, x, y):
+        """Return the id of the topmost space containing the point, if any"""
+        for space_id in sorted(self.boxes.at(x, y), reverse=True):
+            contour = np.array(self.spaces[space_id]["coordinates"], dtype=np.int32)
+            if open_cv.pointPolygonTest(contour, (x, y), False) >= 0:
+                return space_id
+        return None
+
+    def __delete_selected(self):
+        if self.selected is None:
+            return
+        space = self.__remove_space(self.selected)
+        self.selected = None
+        self.drag_start = None
+        self.__redraw(self.__bounds(space))
+        self.needs_present = True
+        print(f"Deleted space #{space['id'] + 1}")
 
     def __handle_done(self):
         """Finalize the current shape being drawn"""
@@ -173,34 +369,14 @@ class CoordinatesGenerator:
         if self.drawing_mode == "polygon" and self.click_count < 4:
             print("Need at least 4 points to complete a polygon")
             return
-            
-        # In polygon mode, close the shape by connecting last point to first
-        if self.drawing_mode == "polygon":
-            # Draw the closing line
-            open_cv.line(self.temp_image,
-                       self.coordinates[-1],
-                       self.coordinates[0],
-                       self.color,
-                       2)
-
-        # Create numpy array for drawing
-        coordinates_array = np.array(self.coordinates)
-        
-        # Write coordinates to YAML output
-        self.output.write("-\n          id: " + str(self.ids) + "\n          coordinates: [")
-        for i, point in enumerate(self.coordinates):
-            self.output.write("[" + str(point[0]) + "," + str(point[1]) + "]")
-            if i < len(self.coordinates) - 1:
-                self.output.write(",")
-        self.output.write("]\n")
-
-        # Draw the final contour on the image
-        draw_contours(self.temp_image, coordinates_array, str(self.ids + 1), COLOR_WHITE)
-        
-        # Update the base image to include this shape
-        self.image = self.temp_image.copy()
-        
-        print(f"Added space #{self.ids + 1}")
-        self.ids += 1
+
+        space = {"id": max(self.spaces, default=-1) + 1, "coordinates": self.coordinates}
+        self.__add_space(space)
+
+        # Draw the final contour into the layout layer
+        self.__redraw(self.__bounds(space))
+
+        print(f"Added space #{space['id'] + 1}")
         self.click_count = 0
         self.coordinates = []
+        self.needs_present = True
@@ -0,0 +1,239 @@
+import cv2 as open_cv
+import numpy as np
+import logging
+import sys
+import time
+from multiprocessing import Process, shared_memory
+from motion_detector import MotionDetector
+
+
+class FrameRing:
+    """Ring of preprocessed frames in shared memory, written by one decoder and read by many detectors.
+
+    Memory layout: int64 header, one int64 cursor per reader, int64 sequence and
+    float64 position per slot, then the BGR frames and the grayed frames.
+    """
+    WRITE_SEQ = 0  # Sequence number of the last published frame
+    CLOSED = 1  # Set once the decoder has reached the end of the video
+    HEIGHT = 2
+    WIDTH = 3
+    SLOTS = 4
+    READERS = 5
+    HEADER_SIZE = 6
+
+    DETACHED = -1  # Cursor value of a reader that stopped consuming
+    POLL_INTERVAL = 0.001  # Seconds to sleep while waiting on the other side
+    SUPERVISE_INTERVAL = 0.05  # Seconds between checks on the decoder and detector processes
+
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner
+
+        self.header = np.ndarray((self.HEADER_SIZE,), dtype=np.int64, buffer=shm.buf)
+        height, width, slots, readers = (int(v) for v in self.header[self.HEIGHT:self.HEADER_SIZE])
+        self.slots = slots
+
+        offset = self.header.nbytes
+        self.cursors = np.ndarray((readers,), dtype=np.int64, buffer=shm.buf, offset=offset)
+        offset += self.cursors.nbytes
+        self.sequences = np.ndarray((slots,), dtype=np.int64, buffer=shm.buf, offset=offset)
+        offset += self.sequences.nbytes
+        self.positions = np.ndarray((slots,), dtype=np.float64, buffer=shm.buf, offset=offset)
+        offset += self.positions.nbytes
+        self.frames = np.ndarray((slots, height, width, 3), dtype=np.uint8, buffer=shm.buf, offset=offset)
+        offset += self.frames.nbytes
+        self.grays = np.ndarray((slots, height, width), dtype=np.uint8, buffer=shm.buf, offset=offset)
+
+    @classmethod
+    def create(cls, height, width, slots=8, readers=1):
+        """Allocate a new ring; the creator owns it and unlinks it on release"""
+        size = 8 * (cls.HEADER_SIZE + readers + 2 * slots) + slots * height * width * 4
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        header = np.ndarray((cls.HEADER_SIZE,), dtype=np.int64, buffer=shm.buf)
+        header[:] = [0, 0, height, width, slots, readers]
+        del header
+        ring = cls(shm, owner=True)
+        ring.cursors[:] = 0
+        ring.sequences[:] = 0
+        return ring
+
+    @classmethod
+    def for_video(cls, video, slots=8, readers=1):
+        """Allocate a ring sized for the frames of the given video"""
+        capture = open_cv.VideoCapture(video)
+        if not capture.isOpened():
+            raise IOError(f"Cannot open video file {video}")
+        width = int(capture.get(open_cv.CAP_PROP_FRAME_WIDTH))
+        height = int(capture.get(open_cv.CAP_PROP_FRAME_HEIGHT))
+        capture.release()
+        return cls.create(height, width, slots, readers)
+
+    @classmethod
+    def attach(cls, name):
+        """Open an existing ring from another process"""
+        if sys.version_info >= (3, 13):
+            # Only the creator should unlink the segment
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, owner=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def publish(self, frame, grayed, position_in_seconds):
+        """Copy a frame into the next slot, waiting until every attached reader is done with it.
+
+        Returns False once no reader is attached anymore.
+        """
+        sequence = int(self.header[self.WRITE_SEQ]) + 1
+        while True:
+            attached = self.cursors[self.cursors != self.DETACHED]
+            if len(attached) == 0:
+                return False
+            # The slot is free once every reader has consumed the frame it held
+            if attached.min() >= sequence - self.slots:
+                break
+            time.sleep(self.POLL_INTERVAL)
+
+        slot = sequence % self.slots
+        self.frames[slot] = frame
+        self.grays[slot] = grayed
+        self.positions[slot] = position_in_seconds
+        self.sequences[slot] = sequence
+        self.header[self.WRITE_SEQ] = sequence
+        return True
+
+    def close(self):
+        """Tell readers that no more frames will be published"""
+        self.header[self.CLOSED] = 1
+
+    def reader(self, index):
+        return FrameRingReader(self, index)
+
+    def release(self):
+        """Drop the views and the mapping; the owner also removes the segment"""
+        self.header = self.cursors = self.sequences = self.positions = self.frames = self.grays = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class FrameRingReader:
+    """Iterates over the frames of a ring as read-only views, without copying them.
+
+    A yielded frame stays valid until the next one is requested, because the
+    reader's cursor only moves past it then.
+    """
+
+    def __init__(self, ring, index):
+        self.ring = ring
+        self.index = index
+
+    def __iter__(self):
+        ring = self.ring
+        try:
+            while ring.cursors[self.index] != FrameRing.DETACHED:
+                sequence = int(ring.cursors[self.index]) + 1
+                while ring.header[FrameRing.WRITE_SEQ] < sequence:
+                    if ring.header[FrameRing.CLOSED]:
+                        # The last frame may have been published just before the ring was closed
+                        if ring.header[FrameRing.WRITE_SEQ] < sequence:
+                            return
+                        break
+                    time.sleep(FrameRing.POLL_INTERVAL)
+
+                slot = sequence % ring.slots
+                frame = ring.frames[slot]
+                grayed = ring.grays[slot]
+                frame.flags.writeable = False
+                grayed.flags.writeable = False
+                yield frame, grayed, float(ring.positions[slot])
+                ring.cursors[self.index] = sequence
+        finally:
+            self.close()
+
+    def close(self):
+        """Detach so the decoder no longer waits for this reader"""
+        if self.ring.cursors is not None:
+            self.ring.cursors[self.index] = FrameRing.DETACHED
+
+    @property
+    def lag(self):
+        """Number of published frames this reader has not consumed yet"""
+        return int(self.ring.header[FrameRing.WRITE_SEQ] - self.ring.cursors[self.index])
+
+
+def publish_video(video, start_frame, ring_name):
+    """Decode and preprocess the video once, publishing every frame into the ring"""
+    ring = FrameRing.attach(ring_name)
+    try:
+        for frame, grayed, position_in_seconds in MotionDetector.read_frames(video, start_frame):
+            if not ring.publish(frame, grayed, position_in_seconds):
+                logging.info("All detectors detached, stopping decoder")
+                break
+    finally:
+        ring.close()
+        ring.release()
+
+
+def consume_frames(ring_name, index, video, coordinates, start_frame, caption, history_path=None,
+                   calibration=None, entrances=None):
+    """Run a MotionDetector on the frames of the ring instead of decoding the video"""
+    ring = FrameRing.attach(ring_name)
+    reader = ring.reader(index)
+    try:
+        detector = MotionDetector(video, coordinates, start_frame, source=iter(reader), caption=caption,
+                                  history_path=history_path, calibration=calibration, entrances=entrances)
+        detector.detect_motion()
+    finally:
+        reader.close()
+        ring.release()
+
+
+def fan_out(video, start_frame, coordinate_sets, captions, history_paths=None, calibration=None, entrances=None,
+            slots=8):
+    """Decode the video in one process and feed every coordinate set from the shared ring"""
+    if history_paths is None:
+        history_paths = [None] * len(coordinate_sets)
+    ring = FrameRing.for_video(video, slots, len(coordinate_sets))
+    try:
+        processes = [Process(target=publish_video, args=(video, start_frame, ring.name))]
+        for index, (coordinates, caption, history_path) in enumerate(zip(coordinate_sets, captions, history_paths)):
+            processes.append(Process(target=consume_frames,
+                                     args=(ring.name, index, video, coordinates, start_frame, caption,
+                                           history_path, calibration, entrances)))
+
+        for process in processes:
+            process.start()
+        supervise(ring, processes[0], processes[1:])
+    finally:
+        ring.release()
+    if processes[0].exitcode != 0:
+        raise RuntimeError(f"Decoder of {video} exited with code {processes[0].exitcode}")
+
+
+def supervise(ring, decoder, consumers):
+    """Wait for the decoder and every consumer, cleaning up after any of them that dies.
+
+    All children are watched at once: a consumer killed without detaching would
+    otherwise stall the decoder, and a killed decoder would never close the ring.
+    Children that fail are logged with their exit code.
+    """
+    running = {None: decoder}
+    running.update(enumerate(consumers))
+    while running:
+        for index, process in list(running.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del running[index]
+            name = "Decoder" if index is None else f"Detector {index}"
+            if process.exitcode != 0:
+                logging.error(f"{name} process exited with code {process.exitcode}")
+            if index is None:
+                ring.close()
+            else:
+                ring.cursors[index] = FrameRing.DETACHED
+        time.sleep(FrameRing.SUPERVISE_INTERVAL)
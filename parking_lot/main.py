@@ -4,6 +4,7 @@ import os
 import sys
 from coordinates_generator import CoordinatesGenerator
 from motion_detector import MotionDetector
+from frame_ring import fan_out
 from colors import *
 import logging
 
@@ -15,9 +16,13 @@ def main():
         args = parse_args()
         
         image_file = args.image_file
-        data_file = args.data_file
+        data_files = args.data_files
+        data_file = data_files[0]
         video_file = args.video_file
         start_frame = args.start_frame
+        history_dir = args.history_dir
+        calibration = load_calibration(args.calibration_file)
+        entrances = load_entrances(args.entrances_file)
         
         # Print file path information for the user
         print_file_info(image_file, data_file, video_file)
@@ -31,6 +36,9 @@ def main():
             return
         
         if image_file is not None:
+            if len(data_files) > 1:
+                logging.error("--image edits a single data file, pass only one with --data")
+                return
             # Check if image file exists before proceeding
             if not os.path.isfile(image_file):
                 logging.error(f"Image file '{image_file}' not found. Please check the file path.")
@@ -38,13 +46,17 @@ def main():
                     logging.info(f"Make sure the directory exists: {os.path.dirname(os.path.abspath(image_file))}")
                 return
                 
-            with open(data_file, "w+") as points:
-                try:
-                    generator = CoordinatesGenerator(image_file, points, COLOR_RED)
-                    generator.generate()
-                except Exception as e:
-                    logging.error(f"Error generating coordinates: {str(e)}")
-                    return
+            # Spaces already in the data file are loaded for editing, not truncated
+            try:
+                generator = CoordinatesGenerator(image_file, data_file, COLOR_RED)
+                generator.generate()
+            except Exception as e:
+                logging.error(f"Error generating coordinates: {str(e)}")
+                return
+
+        if len(data_files) > 1:
+            run_fan_out(video_file, data_files, int(start_frame), history_dir, calibration, entrances)
+            return
 
         try:
             with open(data_file, "r") as data:
@@ -52,7 +64,8 @@ def main():
                 if points is None:
                     logging.error(f"No data found in {data_file}. Make sure the file is not empty.")
                     return
-                detector = MotionDetector(video_file, points, int(start_frame))
+                detector = MotionDetector(video_file, points, int(start_frame), history_path=history_dir,
+                                          calibration=calibration, entrances=entrances)
                 detector.detect_motion()
         except FileNotFoundError:
             logging.error(f"Data file '{data_file}' not found. Please check the file path.")
@@ -62,10 +75,59 @@ def main():
     except Exception as e:
         logging.error(f"An unexpected error occurred: {str(e)}")
         logging.info("Make sure you're using the correct command format:")
-        logging.info("python main.py --image <image_file> --data <data_file> --video <video_file> [--start-frame <frame_number>]")
+        logging.info("python main.py --image <image_file> --data <data_file> [<data_file> ...] --video <video_file> [--start-frame <frame_number>]")
         logging.info("Note: --video is singular, not plural (--videos)")
 
 
+def run_fan_out(video_file, data_files, start_frame, history_dir=None, calibration=None, entrances=None):
+    """Decode the video once and run one detector per data file on the shared frames."""
+    coordinate_sets = []
+    for data_file in data_files:
+        try:
+            with open(data_file, "r") as data:
+                points = yaml.safe_load(data)
+        except FileNotFoundError:
+            logging.error(f"Data file '{data_file}' not found. Please check the file path.")
+            return
+        if points is None:
+            logging.error(f"No data found in {data_file}. Make sure the file is not empty.")
+            return
+        coordinate_sets.append(points)
+
+    captions = [f"{video_file} [{data_file}]" for data_file in data_files]
+    history_paths = None
+    if history_dir is not None:
+        # Each coordinate set keeps its own history, named after its data file
+        history_paths = [os.path.join(history_dir, os.path.splitext(os.path.basename(data_file))[0])
+                         for data_file in data_files]
+
+    logging.info(f"Sharing decoded frames between {len(data_files)} detectors")
+    try:
+        fan_out(video_file, start_frame, coordinate_sets, captions, history_paths, calibration, entrances)
+    except Exception as e:
+        logging.error(f"Error during motion detection: {str(e)}")
+
+
+def load_calibration(calibration_file):
+    """Load detection parameters written by calibration.py, if a file was given."""
+    if calibration_file is None:
+        return None
+    with open(calibration_file, "r") as data:
+        calibration = yaml.safe_load(data)
+    logging.info(f"Using calibration from {calibration_file}")
+    return calibration
+
+
+def load_entrances(entrances_file):
+    """Load named entrance positions ({name: [x, y]}) for nearest vacant space queries, if a file was given."""
+    if entrances_file is None:
+        return None
+    with open(entrances_file, "r") as data:
+        entrances = yaml.safe_load(data) or {}
+    logging.info(f"Using {len(entrances)} entrances from {entrances_file}")
+    return {name: tuple(point) for name, point in entrances.items()}
+
+
 def print_file_info(image_file, data_file, video_file):
     """Print information about file locations to help users understand paths."""
     logging.info(f"Current working directory: {os.getcwd()}")
@@ -100,15 +162,31 @@ def parse_args():
                         help="Video file to detect motion on")
 
     parser.add_argument("--data",
-                        dest="data_file",
+                        dest="data_files",
+                        nargs="+",
                         required=True,
-                        help="Data file to be used with OpenCV")
+                        help="Data file(s) to be used with OpenCV; several files share one decoded video")
 
     parser.add_argument("--start-frame",
                         dest="start_frame",
                         required=False,
                         default=1,
                         help="Starting frame on the video")
+
+    parser.add_argument("--history",
+                        dest="history_dir",
+                        required=False,
+                        help="Directory to keep the per-space occupancy history in")
+
+    parser.add_argument("--calibration",
+                        dest="calibration_file",
+                        required=False,
+                        help="Calibration file written by calibration.py")
+
+    parser.add_argument("--entrances",
+                        dest="entrances_file",
+                        required=False,
+                        help="YAML file mapping entrance names to [x, y] pixel positions")
     
     # Check for common errors in command line arguments
     if '--videos' in sys.argv and '--video' not in sys.argv:
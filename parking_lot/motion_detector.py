@@ -4,17 +4,28 @@ import logging
 import time
 from datetime import datetime
 from drawing_utils import draw_contours
+from zones import ParkingIndex
+from occupancy_store import OccupancyStore
+from stabilizer import CameraStabilizer
 from colors import COLOR_GREEN, COLOR_WHITE, COLOR_BLUE, COLOR_RED
 
 
 class MotionDetector:
     LAPLACIAN = 1.4  # Threshold for motion detection
     DETECT_DELAY = 1  # Delay in seconds before confirming status change
+    SKIP_FRAMES = 20  # Frames skipped at start to let the camera stabilize
+    DIFF_THRESHOLD = 30  # Gray level change from the reference frame that counts as different
+    MOTION_WEIGHT = 0.3  # Weight of the laplacian in the combined metric
+    DIFF_WEIGHT = 10  # Weight of the fraction of changed pixels in the combined metric
 
-    def __init__(self, video, coordinates, start_frame):
+    def __init__(self, video, coordinates, start_frame, source=None, caption=None, history_path=None,
+                 calibration=None, stabilize=True, entrances=None):
         self.video = video
         self.coordinates_data = coordinates
         self.start_frame = start_frame
+        # Iterable of (frame, grayed, position_in_seconds); decodes the video itself when None
+        self.source = source
+        self.caption = caption if caption is not None else str(video)
         self.contours = []
         self.bounds = []
         self.mask = []
@@ -23,23 +34,172 @@ class MotionDetector:
         self.total_spaces = len(coordinates)
         self.vacant_spaces = 0
         self.occupied_spaces = 0
+        # Per-zone counts and nearest vacant space lookups, to a position or a named entrance
+        self.index = ParkingIndex(coordinates, entrances)
         self.last_update = time.time()
         self.vacancy_history = []
+        # Per-space timeline of committed status changes, kept on disk when a path is given
+        self.history = None
+        if history_path is not None:
+            self.history = OccupancyStore(history_path, [p["id"] for p in coordinates])
+            # Start from the stored statuses, so a restart does not look like every car leaving
+            for index in np.flatnonzero(self.history.statuses):
+                self.index.set_status(int(index), True)
         self.detection_sensitivity = self.LAPLACIAN
+        self.diff_threshold = self.DIFF_THRESHOLD
+        self.motion_weight = self.MOTION_WEIGHT
+        self.diff_weight = self.DIFF_WEIGHT
+        # Per-space shift of the sensitivity, so '+'/'-' still move every space together
+        self.sensitivity_offsets = [0.0] * len(coordinates)
+        if calibration is not None:
+            self._apply_calibration(calibration)
         
         # Reference frames for better comparison
         self.reference_frames = []
+        # Camera shake compensation: ROIs are moved by the global shift against the reference
+        self.stabilizer = CameraStabilizer() if stabilize else None
+        self.shift = (0, 0)
         self.frame_count = 0
         self.is_reference_set = False
 
     def detect_motion(self):
-        capture = open_cv.VideoCapture(self.video)
-        capture.set(open_cv.CAP_PROP_POS_FRAMES, self.start_frame)
+        frames = self.source
+        if frames is None:
+            frames = self.read_frames(self.video, self.start_frame)
+
+        coordinates_data = self.coordinates_data
+        self._prepare_spaces()
+
+        statuses = self.index.statuses  # False = vacant, True = occupied; committed through the index
+        times = [None] * len(coordinates_data)
+
+        # Display controls
+        print("Controls:")
+        print("- Press 'q' to exit")
+        print("- Press '+' to increase detection sensitivity")
+        print("- Press '-' to decrease detection sensitivity")
+        print("- Press 's' to save current frame")
+        print("Motion detection started...")
+
+        try:
+            for frame, grayed, position_in_seconds in frames:
+                new_frame = frame.copy()
+
+                # Collect reference frames during first 30 frames
+                if self.frame_count < 30 and not self.is_reference_set:
+                    self._collect_reference_frames(grayed)
+                    self.frame_count += 1
+                
+                    # Show progress during initialization
+                    cv_text = f"Initializing: {int(self.frame_count/30*100)}%"
+                    open_cv.putText(new_frame, cv_text, (10, 30), 
+                                 open_cv.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 255), 2)
+                    open_cv.imshow(self.caption, new_frame)
+                    open_cv.waitKey(1)
+                    continue
+            
+                self.is_reference_set = True
+                if self.stabilizer is not None:
+                    self.shift = self.stabilizer.update(grayed)
+            
+                # Process each parking space
+                for index, c in enumerate(coordinates_data):
+                    status = self.__apply(grayed, index, c)
+
+                    # Handle status changes with delay to avoid flickering
+                    if times[index] is not None and self.same_status(statuses, index, status):
+                        times[index] = None
+                        continue
+
+                    if times[index] is not None and self.status_changed(statuses, index, status):
+                        if position_in_seconds - times[index] >= MotionDetector.DETECT_DELAY:
+                            self.index.set_status(index, status)
+                            self._record_history(index, status)
+                            times[index] = None
+                        continue
+
+                    if times[index] is None and self.status_changed(statuses, index, status):
+                        times[index] = position_in_seconds
+
+                # Update statistics
+                self.vacant_spaces = self.index.vacant
+                self.occupied_spaces = self.index.occupied
+            
+                # Add stats to history every 5 seconds
+                current_time = time.time()
+                if current_time - self.last_update > 5:
+                    self.vacancy_history.append((datetime.now(), self.vacant_spaces, self.occupied_spaces))
+                    self.last_update = current_time
+
+                # Add parking space markers with status indicators
+                for index, p in enumerate(coordinates_data):
+                    coordinates = self._coordinates(p) + self._space_shift(index, grayed.shape)
+                
+                    # Green for vacant, Blue for occupied
+                    color = COLOR_GREEN if not statuses[index] else COLOR_BLUE
+                    space_id = str(p["id"] + 1)
+                
+                    # Draw the parking space contour
+                    draw_contours(new_frame, coordinates, space_id, COLOR_WHITE, color)
+
+                # Display statistics on frame
+                self.__draw_stats(new_frame)
+            
+                # Show the frame
+                open_cv.imshow(self.caption, new_frame)
+            
+                # Process keypresses
+                k = open_cv.waitKey(1)
+                if k == ord("q"):
+                    break
+                elif k == ord("+") or k == ord("="):  # Increase sensitivity
+                    self.detection_sensitivity -= 0.1
+                    if self.detection_sensitivity < 0.1:
+                        self.detection_sensitivity = 0.1
+                    print(f"Sensitivity increased: {self.detection_sensitivity:.1f}")
+                elif k == ord("-") or k == ord("_"):  # Decrease sensitivity
+                    self.detection_sensitivity += 0.1
+                    print(f"Sensitivity decreased: {self.detection_sensitivity:.1f}")
+                elif k == ord("s"):  # Save current frame
+                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                    filename = f"parking_status_{timestamp}.jpg"
+                    open_cv.imwrite(filename, new_frame)
+                    print(f"Saved frame as {filename}")
+                
+        finally:
+            # Clean up, flushing the history even when detection fails
+            if self.history is not None:
+                self.history.close()
+            if hasattr(frames, "close"):
+                frames.close()
+            open_cv.destroyAllWindows()
         
-        # Check if video opened successfully
-        if not capture.isOpened():
-            raise IOError(f"Cannot open video file {self.video}")
+        # Print final statistics
+        print("\nFinal Statistics:")
+        print(f"Total spaces: {self.total_spaces}")
+        print(f"Vacant spaces: {self.vacant_spaces}")
+        print(f"Occupied spaces: {self.occupied_spaces}")
+        for key in ParkingIndex.GROUP_KEYS:
+            for value, (vacant, occupied) in sorted(self.index.group_counts(key).items(), key=lambda item: str(item[0])):
+                print(f"{key.capitalize()} {value}: {vacant} vacant, {occupied} occupied")
+        for entrance in self.index.entrances:
+            nearest = self.index.nearest_vacant(entrance)
+            if nearest:
+                print(f"Nearest vacant space to {entrance}: #{nearest[0][1] + 1}")
+    
+    def _record_history(self, index, status):
+        """Store a committed status change, keeping timestamps in order if the wall clock steps back"""
+        if self.history is None:
+            return
+        timestamp = time.time()
+        if self.history.last_time is not None and timestamp < self.history.last_time:
+            logging.warning(f"Clock went back {self.history.last_time - timestamp:.1f}s, "
+                            f"recording space {index} at the last stored time")
+            timestamp = self.history.last_time
+        self.history.record(timestamp, index, status)
 
+    def _prepare_spaces(self):
+        """Compute the bounding rectangle and mask of every parking space"""
         coordinates_data = self.coordinates_data
         logging.debug("coordinates data: %s", coordinates_data)
 
@@ -71,168 +231,104 @@ class MotionDetector:
             mask = mask == 255
             self.mask.append(mask)
             logging.debug("mask: %s", self.mask)
-            
+
             # Initialize reference frames
             self.reference_frames.append(None)
 
-        statuses = [False] * len(coordinates_data)  # False = vacant, True = occupied
-        times = [None] * len(coordinates_data)
-
-        # Display controls
-        print("Controls:")
-        print("- Press 'q' to exit")
-        print("- Press '+' to increase detection sensitivity")
-        print("- Press '-' to decrease detection sensitivity")
-        print("- Press 's' to save current frame")
-        print("Motion detection started...")
+    def _apply_calibration(self, calibration):
+        """Use the parameters found by calibration.py instead of the defaults"""
+        self.diff_threshold = calibration.get("diff_threshold", self.diff_threshold)
+        self.motion_weight = calibration.get("motion_weight", self.motion_weight)
+        self.diff_weight = calibration.get("diff_weight", self.diff_weight)
+        self.detection_sensitivity = calibration.get("sensitivity", self.detection_sensitivity)
 
-        # Skip first few frames to stabilize camera and collect reference frames
-        for _ in range(20):
-            result, _ = capture.read()
-            if not result:
-                break
+        indexes = {p["id"]: index for index, p in enumerate(self.coordinates_data)}
+        for space_id, sensitivity in (calibration.get("spaces") or {}).items():
+            if space_id in indexes:
+                self.sensitivity_offsets[indexes[space_id]] = sensitivity - self.detection_sensitivity
 
-        while capture.isOpened():
-            result, frame = capture.read()
-            if frame is None:
-                break
+    @staticmethod
+    def read_frames(video, start_frame):
+        """Decode the video and yield (frame, grayed, position_in_seconds) for each frame"""
+        capture = open_cv.VideoCapture(video)
+        capture.set(open_cv.CAP_PROP_POS_FRAMES, start_frame)
 
-            if not result:
-                raise CaptureReadError("Error reading video capture on frame %s" % str(frame))
+        # Check if video opened successfully
+        if not capture.isOpened():
+            raise IOError(f"Cannot open video file {video}")
 
-            # Process the frame
-            blurred = open_cv.GaussianBlur(frame.copy(), (5, 5), 3)
-            grayed = open_cv.cvtColor(blurred, open_cv.COLOR_BGR2GRAY)
-            new_frame = frame.copy()
-            
-            position_in_seconds = capture.get(open_cv.CAP_PROP_POS_MSEC) / 1000.0
-            
-            # Collect reference frames during first 30 frames
-            if self.frame_count < 30 and not self.is_reference_set:
-                self._collect_reference_frames(grayed)
-                self.frame_count += 1
-                
-                # Show progress during initialization
-                cv_text = f"Initializing: {int(self.frame_count/30*100)}%"
-                open_cv.putText(new_frame, cv_text, (10, 30), 
-                             open_cv.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 255), 2)
-                open_cv.imshow(str(self.video), new_frame)
-                open_cv.waitKey(1)
-                continue
-            
-            self.is_reference_set = True
-            
-            # Process each parking space
-            for index, c in enumerate(coordinates_data):
-                status = self.__apply(grayed, index, c)
+        try:
+            # Skip first few frames to stabilize camera and collect reference frames
+            for _ in range(MotionDetector.SKIP_FRAMES):
+                result, _ = capture.read()
+                if not result:
+                    break
 
-                # Handle status changes with delay to avoid flickering
-                if times[index] is not None and self.same_status(statuses, index, status):
-                    times[index] = None
-                    continue
+            while capture.isOpened():
+                result, frame = capture.read()
+                if frame is None:
+                    break
 
-                if times[index] is not None and self.status_changed(statuses, index, status):
-                    if position_in_seconds - times[index] >= MotionDetector.DETECT_DELAY:
-                        statuses[index] = status
-                        times[index] = None
-                    continue
+                if not result:
+                    raise CaptureReadError("Error reading video capture on frame %s" % str(frame))
 
-                if times[index] is None and self.status_changed(statuses, index, status):
-                    times[index] = position_in_seconds
+                position_in_seconds = capture.get(open_cv.CAP_PROP_POS_MSEC) / 1000.0
+                yield frame, MotionDetector.preprocess(frame), position_in_seconds
+        finally:
+            capture.release()
 
-            # Update statistics
-            self.vacant_spaces = statuses.count(False)  # Count vacant spaces
-            self.occupied_spaces = statuses.count(True)  # Count occupied spaces
-            
-            # Add stats to history every 5 seconds
-            current_time = time.time()
-            if current_time - self.last_update > 5:
-                self.vacancy_history.append((datetime.now(), self.vacant_spaces, self.occupied_spaces))
-                self.last_update = current_time
-
-            # Add parking space markers with status indicators
-            for index, p in enumerate(coordinates_data):
-                coordinates = self._coordinates(p)
-                
-                # Green for vacant, Blue for occupied
-                color = COLOR_GREEN if not statuses[index] else COLOR_BLUE
-                space_id = str(p["id"] + 1)
-                
-                # Draw the parking space contour
-                draw_contours(new_frame, coordinates, space_id, COLOR_WHITE, color)
+    @staticmethod
+    def preprocess(frame):
+        """Blur and gray a frame the way every parking space is scored"""
+        blurred = open_cv.GaussianBlur(frame, (5, 5), 3)
+        return open_cv.cvtColor(blurred, open_cv.COLOR_BGR2GRAY)
 
-            # Display statistics on frame
-            self.__draw_stats(new_frame)
-            
-            # Show the frame
-            open_cv.imshow(str(self.video), new_frame)
-            
-            # Process keypresses
-            k = open_cv.waitKey(1)
-            if k == ord("q"):
-                break
-            elif k == ord("+") or k == ord("="):  # Increase sensitivity
-                self.detection_sensitivity -= 0.1
-                if self.detection_sensitivity < 0.1:
-                    self.detection_sensitivity = 0.1
-                print(f"Sensitivity increased: {self.detection_sensitivity:.1f}")
-            elif k == ord("-") or k == ord("_"):  # Decrease sensitivity
-                self.detection_sensitivity += 0.1
-                print(f"Sensitivity decreased: {self.detection_sensitivity:.1f}")
-            elif k == ord("s"):  # Save current frame
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                filename = f"parking_status_{timestamp}.jpg"
-                open_cv.imwrite(filename, new_frame)
-                print(f"Saved frame as {filename}")
-                
-        # Clean up
-        capture.release()
-        open_cv.destroyAllWindows()
-        
-        # Print final statistics
-        print("\nFinal Statistics:")
-        print(f"Total spaces: {self.total_spaces}")
-        print(f"Vacant spaces: {self.vacant_spaces}")
-        print(f"Occupied spaces: {self.occupied_spaces}")
-    
     def _collect_reference_frames(self, grayed):
         """Collect reference frames for better comparison"""
         for index, p in enumerate(self.coordinates_data):
             if self.reference_frames[index] is None:
-                coordinates = self._coordinates(p)
                 rect = self.bounds[index]
                 roi_gray = grayed[rect[1]:(rect[1] + rect[3]), rect[0]:(rect[0] + rect[2])]
-                self.reference_frames[index] = roi_gray
+                # Copy, since grayed may be a view into a shared frame buffer that gets reused
+                self.reference_frames[index] = roi_gray.copy()
+
+        if self.stabilizer is not None and self.stabilizer.reference is None:
+            self.stabilizer.set_reference(grayed)
+
+    def _space_shift(self, index, shape):
+        """Return the camera shift of a parking space, clamped so its region stays inside the frame"""
+        x, y, width, height = self.bounds[index]
+        # The region keeps the reference's size, so it stops at the frame edge instead of being cut.
+        # A space drawn past the edge is never pushed further out, nor moved without a shift.
+        dx = min(max(x + self.shift[0], min(x, 0)), max(shape[1] - width, x)) - x
+        dy = min(max(y + self.shift[1], min(y, 0)), max(shape[0] - height, y)) - y
+        return dx, dy
+
+    def _roi(self, grayed, index):
+        """Return the region of a parking space, moved by the current camera shift"""
+        x, y, width, height = self.bounds[index]
+        dx, dy = self._space_shift(index, grayed.shape)
+        return grayed[(y + dy):(y + dy + height), (x + dx):(x + dx + width)]
 
     def __apply(self, grayed, index, p):
         """Apply motion detection to a specific parking space"""
-        coordinates = self._coordinates(p)
-        rect = self.bounds[index]
-
         # Extract the region of interest (ROI) for this parking space
-        roi_gray = grayed[rect[1]:(rect[1] + rect[3]), rect[0]:(rect[0] + rect[2])]
+        roi_gray = self._roi(grayed, index)
         
+        sensitivity = self.detection_sensitivity + self.sensitivity_offsets[index]
+
         # Compare against reference frame if available
         if self.reference_frames[index] is not None:
-            # Calculate absolute difference between current frame and reference
-            absdiff = open_cv.absdiff(roi_gray, self.reference_frames[index])
-            _, thresholded = open_cv.threshold(absdiff, 30, 255, open_cv.THRESH_BINARY)
-            
-            # Apply laplacian for edge detection
-            laplacian = open_cv.Laplacian(roi_gray, open_cv.CV_64F)
-            
-            # Calculate metrics
-            motion_value = np.mean(np.abs(laplacian * self.mask[index]))
-            diff_value = np.mean(thresholded * self.mask[index]) / 255.0
+            motion_value, (diff_value,) = self._space_features(roi_gray, index, [self.diff_threshold])
             
             # Combined metric
-            combined_value = motion_value * 0.3 + diff_value * 10
+            combined_value = motion_value * self.motion_weight + diff_value * self.diff_weight
             
             # FIXED LOGIC: Lower values mean less change (vacant), higher values mean more change (occupied)
-            status = combined_value > self.detection_sensitivity
+            status = combined_value > sensitivity
             
             logging.debug(f"Space {index}: motion value: {motion_value:.2f}, diff: {diff_value:.2f}, "
-                         f"combined: {combined_value:.2f}, threshold: {self.detection_sensitivity:.2f}, "
+                         f"combined: {combined_value:.2f}, threshold: {sensitivity:.2f}, "
                          f"occupied: {status}")
             
             return status
@@ -243,21 +339,40 @@ class MotionDetector:
             
             # FIXED LOGIC: Lower values mean less change (vacant), higher values mean more change (occupied)
             # Higher threshold means more sensitivity (more likely to mark as vacant)
-            status = motion_value > self.detection_sensitivity
+            status = motion_value > sensitivity
             
-            logging.debug(f"Space {index}: motion value: {motion_value:.2f}, threshold: {self.detection_sensitivity:.2f}, "
+            logging.debug(f"Space {index}: motion value: {motion_value:.2f}, threshold: {sensitivity:.2f}, "
                          f"occupied: {status}")
             
             return status
 
+    def _space_features(self, roi_gray, index, diff_thresholds):
+        """Return the laplacian motion value of a space and its changed pixel fraction for each threshold"""
+        mask = self.mask[index]
+
+        # Apply laplacian for edge detection
+        laplacian = open_cv.Laplacian(roi_gray, open_cv.CV_64F)
+        motion_value = np.mean(np.abs(laplacian * mask))
+
+        # Calculate absolute difference between current frame and reference, then count the
+        # masked pixels above every threshold from a single histogram
+        absdiff = open_cv.absdiff(roi_gray, self.reference_frames[index])
+        histogram = np.bincount(absdiff[mask], minlength=256)
+        above = histogram.sum() - np.cumsum(histogram)
+        diff_values = above[np.asarray(diff_thresholds, dtype=int)] / float(mask.size)
+
+        return motion_value, diff_values
+
     def __draw_stats(self, frame):
         """Draw statistics on the frame"""
         # Get frame dimensions
         height, width = frame.shape[:2]
         
+        zone_counts = sorted(self.index.group_counts("zone").items(), key=lambda item: str(item[0]))
+
         # Create semi-transparent overlay for the stats panel
         overlay = frame.copy()
-        open_cv.rectangle(overlay, (10, 10), (250, 120), (0, 0, 0), -1)
+        open_cv.rectangle(overlay, (10, 10), (250, 120 + 25 * len(zone_counts)), (0, 0, 0), -1)
         open_cv.addWeighted(overlay, 0.7, frame, 0.3, 0, frame)
         
         # Add text for statistics
@@ -274,6 +389,11 @@ class MotionDetector:
         # Occupied spaces in red
         open_cv.putText(frame, f"Occupied: {self.occupied_spaces}", (20, 110), 
                       open_cv.FONT_HERSHEY_SIMPLEX, 0.6, COLOR_RED, 2)
+
+        # Vacant spaces per zone, when the coordinates are tagged with zones
+        for i, (zone, (vacant, occupied)) in enumerate(zone_counts):
+            open_cv.putText(frame, f"Zone {zone}: {vacant}/{vacant + occupied} vacant", (20, 135 + 25 * i),
+                          open_cv.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
         
         # Add video time
         video_time = open_cv.getTickCount() / open_cv.getTickFrequency()
@@ -0,0 +1,200 @@
+import bisect
+import numpy as np
+import os
+import time
+
+
+class OccupancyStore:
+    """Append-only, per-space occupancy timeline kept on disk.
+
+    Only committed status changes are stored, so each space's timeline is
+    run-length encoded: a run lasts from one change to the next. Changes are
+    grouped in chunks of CHUNK_SECONDS. Every chunk has an events file of fixed
+    size records, which is memory-mapped for queries, and a snapshot of all
+    statuses at the moment the chunk was opened. A query only reads the chunks
+    that overlap its time range. Spaces are stored by their position in the
+    coordinates list, so the ids of those spaces are kept with the history and
+    must match when it is opened again.
+    """
+    CHUNK_SECONDS = 24 * 3600
+    FLUSH_EVENTS = 256  # Buffered changes written to disk at once
+    EVENT_DTYPE = np.dtype([("time", "<f8"), ("space", "<u4"), ("status", "u1")])
+
+    def __init__(self, path, space_ids):
+        self.path = path
+        self.ids = np.array(space_ids, dtype=np.int64)
+        self.spaces = spaces = len(self.ids)
+        os.makedirs(path, exist_ok=True)
+
+        self.chunks = sorted(int(name[len("chunk_"):-len(".events")]) for name in os.listdir(path)
+                             if name.startswith("chunk_") and name.endswith(".events"))
+        self.pending = []
+        self.last_time = None
+        self.statuses = np.zeros(spaces, dtype=bool)  # False = vacant, True = occupied
+
+        ids_file = os.path.join(path, "ids.npy")
+        if os.path.isfile(ids_file):
+            stored_ids = np.load(ids_file)
+            if not np.array_equal(stored_ids, self.ids):
+                raise ValueError(f"History in '{path}' was kept for spaces {stored_ids.tolist()}, "
+                                 f"not {self.ids.tolist()}; use another history directory for a changed layout")
+        else:
+            np.save(ids_file, self.ids)
+
+        if self.chunks:
+            last_chunk = self.chunks[-1]
+            snapshot = self._snapshot(last_chunk)
+            if len(snapshot) != spaces:
+                raise ValueError(f"History in '{path}' has {len(snapshot)} spaces, expected {spaces}")
+            # Drop a partly written record left behind by an interrupted flush, before appending after it
+            filename = self._file(last_chunk, ".events")
+            size = os.path.getsize(filename)
+            if size % self.EVENT_DTYPE.itemsize:
+                os.truncate(filename, size - size % self.EVENT_DTYPE.itemsize)
+            events = self._chunk_events(last_chunk)
+            self.statuses = self._apply(snapshot, events)
+            self.last_time = float(events["time"][-1]) if len(events) else float(last_chunk)
+
+    def record(self, timestamp, space, status):
+        """Append a committed status change of one space"""
+        if self.last_time is not None and timestamp < self.last_time:
+            raise ValueError(f"Status changes must be recorded in time order ({timestamp} < {self.last_time})")
+
+        chunk = int(timestamp // self.CHUNK_SECONDS) * self.CHUNK_SECONDS
+        if not self.chunks or chunk > self.chunks[-1]:
+            self.flush()
+            np.save(self._file(chunk, ".start.npy"), self.statuses.astype(np.uint8))
+            open(self._file(chunk, ".events"), "ab").close()
+            self.chunks.append(chunk)
+
+        self.pending.append((timestamp, space, status))
+        self.statuses[space] = status
+        self.last_time = timestamp
+        if len(self.pending) >= self.FLUSH_EVENTS:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with open(self._file(self.chunks[-1], ".events"), "ab") as events:
+            events.write(np.array(self.pending, dtype=self.EVENT_DTYPE).tobytes())
+        self.pending = []
+
+    def close(self):
+        self.flush()
+
+    def occupancy_at(self, timestamp):
+        """Return the status of every space at the given time, reading a single chunk"""
+        self.flush()
+        index = bisect.bisect_right(self.chunks, timestamp) - 1
+        if index < 0:
+            return np.zeros(self.spaces, dtype=bool)
+        chunk = self.chunks[index]
+        events = self._chunk_events(chunk)
+        events = events[:np.searchsorted(events["time"], timestamp, side="right")]
+        return self._apply(self._snapshot(chunk), events)
+
+    def runs(self, start, end):
+        """Return (space, begin, finish, status) arrays of the runs of every space clipped to [start, end]"""
+        initial = self.occupancy_at(start)
+        events = self._events(start, end)
+        spaces = np.arange(self.spaces)
+
+        # Bracket each timeline with its status at start and an end marker, then group by space
+        times = np.concatenate([np.full(self.spaces, start, dtype=np.float64), events["time"],
+                                np.full(self.spaces, end, dtype=np.float64)])
+        owners = np.concatenate([spaces, events["space"], spaces])
+        statuses = np.concatenate([initial, events["status"].astype(bool), initial])
+        is_end = np.zeros(len(times), dtype=bool)
+        is_end[-self.spaces:] = True
+
+        order = np.argsort(owners, kind="stable")
+        times, owners, statuses, is_end = times[order], owners[order], statuses[order], is_end[order]
+
+        # A change to the status a space already had does not start a new run
+        first = np.ones(len(times), dtype=bool)
+        first[1:] = owners[1:] != owners[:-1]
+        repeated = np.zeros(len(times), dtype=bool)
+        repeated[1:] = statuses[1:] == statuses[:-1]
+        keep = first | ~repeated | is_end
+        times, owners, statuses, is_end = times[keep], owners[keep], statuses[keep], is_end[keep]
+
+        starts = ~is_end
+        begin = times[starts]
+        finish = times[np.flatnonzero(starts) + 1]
+        return owners[starts], begin, finish, statuses[starts]
+
+    def dwell_times(self, start, end, space=None):
+        """Return the durations in seconds of the stays that began and ended within [start, end]"""
+        owners, begin, finish, statuses = self.runs(start, end)
+        complete = statuses & (begin > start) & (finish < end)
+        if space is not None:
+            complete &= owners == space
+        return finish[complete] - begin[complete]
+
+    def turnover(self, start, end):
+        """Return the number of arrivals per space within [start, end]"""
+        owners, begin, _, statuses = self.runs(start, end)
+        return np.bincount(owners[statuses & (begin > start)], minlength=self.spaces)
+
+    def hourly_profile(self, start, end, step=300, utc_offset=None):
+        """Return the mean occupied fraction of the lot for each hour of the day (24 values, NaN if unseen).
+
+        Hours are local time, following daylight saving changes within the range,
+        unless a fixed utc_offset in seconds is given.
+        """
+        _, begin, finish, statuses = self.runs(start, end)
+        begins = np.sort(begin[statuses])
+        finishes = np.sort(finish[statuses])
+
+        samples = np.arange(start, end, step, dtype=np.float64)
+        occupied = (np.searchsorted(begins, samples, side="right")
+                    - np.searchsorted(finishes, samples, side="right"))
+
+        if utc_offset is None:
+            # Offsets only change on a quarter hour, so look them up once per quarter hour sampled
+            quarters, inverse = np.unique(samples // 900, return_inverse=True)
+            utc_offset = np.array([time.localtime(quarter * 900).tm_gmtoff for quarter in quarters])[inverse]
+        hours = ((samples + utc_offset) // 3600 % 24).astype(int)
+        total = np.bincount(hours, weights=occupied / max(self.spaces, 1), minlength=24)
+        seen = np.bincount(hours, minlength=24)
+        with np.errstate(invalid="ignore"):
+            return total / seen
+
+    def _events(self, start, end):
+        """Return the changes with start < time <= end, reading only the overlapping chunks"""
+        self.flush()
+        first = max(bisect.bisect_right(self.chunks, start) - 1, 0)
+        last = bisect.bisect_right(self.chunks, end)
+        selected = []
+        for chunk in self.chunks[first:last]:
+            events = self._chunk_events(chunk)
+            times = events["time"]
+            selected.append(events[np.searchsorted(times, start, side="right"):
+                                   np.searchsorted(times, end, side="right")])
+        if not selected:
+            return np.zeros(0, dtype=self.EVENT_DTYPE)
+        return np.concatenate(selected)
+
+    def _chunk_events(self, chunk):
+        filename = self._file(chunk, ".events")
+        count = os.path.getsize(filename) // self.EVENT_DTYPE.itemsize
+        if count == 0:
+            return np.zeros(0, dtype=self.EVENT_DTYPE)
+        return np.memmap(filename, dtype=self.EVENT_DTYPE, mode="r", shape=(count,))
+
+    def _snapshot(self, chunk):
+        return np.load(self._file(chunk, ".start.npy"), mmap_mode="r").astype(bool)
+
+    def _file(self, chunk, suffix):
+        return os.path.join(self.path, f"chunk_{chunk:012d}{suffix}")
+
+    @staticmethod
+    def _apply(snapshot, events):
+        """Apply changes in time order to a copy of the snapshot, the latest change of a space winning"""
+        statuses = np.array(snapshot, dtype=bool)
+        if len(events):
+            spaces = events["space"][::-1]
+            latest, index = np.unique(spaces, return_index=True)
+            statuses[latest] = events["status"][::-1][index].astype(bool)
+        return statuses
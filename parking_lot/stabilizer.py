@@ -0,0 +1,78 @@
+import cv2 as open_cv
+import numpy as np
+
+
+class CameraStabilizer:
+    """Estimates the global translation of the camera against the reference frame.
+
+    The shift is found by phase correlation on a heavily downscaled copy of the
+    frame, then refined at full resolution on a small patch from the centre of
+    the frame. This runs only every UPDATE_EVERY frames and is cached in between.
+    Callers move their regions of interest by the shift instead of warping whole frames.
+    """
+    UPDATE_EVERY = 5  # Frames between two estimates
+    WORK_WIDTH = 320  # Width of the downscaled frames the shift is estimated on
+    REFINE_SIZE = 256  # Side of the full resolution patch the coarse shift is refined on
+    MIN_RESPONSE = 0.05  # Weaker correlation peaks are ignored and the last shift is kept
+
+    def __init__(self, update_every=UPDATE_EVERY):
+        self.update_every = update_every
+        self.reference = None
+        self.window = None
+        self.patch = None  # Top-left corner of the refinement patch in the reference frame
+        self.patch_reference = None
+        self.patch_window = None
+        self.scale = 1.0
+        self.frame_count = 0
+        self.shift = (0, 0)  # (dx, dy) in full resolution pixels
+
+    def set_reference(self, grayed):
+        self.scale = min(1.0, self.WORK_WIDTH / grayed.shape[1])
+        self.reference = self._downscale(grayed)
+        self.window = open_cv.createHanningWindow(self.reference.shape[::-1], open_cv.CV_32F)
+
+        # Refining only pays off when the coarse estimate lost resolution
+        height, width = grayed.shape
+        if self.scale < 1.0 and min(height, width) > self.REFINE_SIZE:
+            self.patch = ((width - self.REFINE_SIZE) // 2, (height - self.REFINE_SIZE) // 2)
+            self.patch_reference = self._patch(grayed, 0, 0)
+            self.patch_window = open_cv.createHanningWindow((self.REFINE_SIZE, self.REFINE_SIZE), open_cv.CV_32F)
+        self.frame_count = 0
+        self.shift = (0, 0)
+
+    def update(self, grayed):
+        """Return the current shift, estimating it again every update_every frames"""
+        if self.reference is None:
+            self.set_reference(grayed)
+            return self.shift
+
+        self.frame_count += 1
+        if self.frame_count % self.update_every:
+            return self.shift
+
+        (dx, dy), response = open_cv.phaseCorrelate(self.reference, self._downscale(grayed), self.window)
+        if response < self.MIN_RESPONSE:
+            return self.shift
+        dx, dy = dx / self.scale, dy / self.scale
+
+        if self.patch is not None:
+            patch = self._patch(grayed, int(round(dx)), int(round(dy)))
+            if patch is not None:
+                (rx, ry), response = open_cv.phaseCorrelate(self.patch_reference, patch, self.patch_window)
+                if response >= self.MIN_RESPONSE:
+                    dx, dy = round(dx) + rx, round(dy) + ry
+
+        self.shift = (int(round(dx)), int(round(dy)))
+        return self.shift
+
+    def _patch(self, grayed, dx, dy):
+        """Return the refinement patch moved by (dx, dy), or None when that leaves the frame"""
+        x, y = self.patch[0] + dx, self.patch[1] + dy
+        if x < 0 or y < 0 or x + self.REFINE_SIZE > grayed.shape[1] or y + self.REFINE_SIZE > grayed.shape[0]:
+            return None
+        return np.float32(grayed[y:(y + self.REFINE_SIZE), x:(x + self.REFINE_SIZE)])
+
+    def _downscale(self, grayed):
+        if self.scale < 1.0:
+            grayed = open_cv.resize(grayed, None, fx=self.scale, fy=self.scale, interpolation=open_cv.INTER_AREA)
+        return np.float32(grayed)
@@ -1 +1,508 @@
+import os
+import signal
+import sys
+import tempfile
+import time
+import unittest
+from multiprocessing import Process
+from unittest import mock
 
+import cv2 as open_cv
+import numpy as np
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import calibration
+from box_grid import BoxGrid
+from coordinates_generator import CoordinatesGenerator
+from frame_ring import FrameRing, fan_out, publish_video, supervise
+from motion_detector import MotionDetector
+from occupancy_store import OccupancyStore
+from stabilizer import CameraStabilizer
+from zones import ParkingIndex
+
+
+def write_video(path, frames, size=(64, 48)):
+    writer = open_cv.VideoWriter(path, open_cv.VideoWriter_fourcc(*"MJPG"), 25, size)
+    for i in range(frames):
+        writer.write(np.full((size[1], size[0], 3), i % 256, dtype=np.uint8))
+    writer.release()
+
+
+def read_all(ring_name, index):
+    ring = FrameRing.attach(ring_name)
+    reader = ring.reader(index)
+    for _ in reader:
+        pass
+    ring.release()
+
+
+def fail_to_decode(video, start_frame, ring_name):
+    raise IOError(f"Cannot open video file {video}")
+
+
+def read_then_die(ring_name, index):
+    ring = FrameRing.attach(ring_name)
+    for count, _ in enumerate(ring.reader(index)):
+        if count == 2:
+            # Die without running any cleanup, like a segfault
+            os.kill(os.getpid(), signal.SIGKILL)
+
+
+class FrameRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = FrameRing.create(4, 4, slots=4, readers=1)
+
+    def tearDown(self):
+        self.ring.release()
+
+    def test_reader_gets_frames_published_before_close(self):
+        for i in range(3):
+            self.ring.publish(np.full((4, 4, 3), i, np.uint8), np.full((4, 4), i, np.uint8), float(i))
+        self.ring.close()
+
+        positions = [position for _, _, position in self.ring.reader(0)]
+        self.assertEqual(positions, [0.0, 1.0, 2.0])
+
+    def test_supervise_survives_killed_consumer(self):
+        directory = tempfile.mkdtemp()
+        video = os.path.join(directory, "video.avi")
+        write_video(video, 120)
+
+        ring = FrameRing.for_video(video, slots=4, readers=2)
+        try:
+            decoder = Process(target=publish_video, args=(video, 1, ring.name))
+            consumers = [Process(target=read_all, args=(ring.name, 0)),
+                         Process(target=read_then_die, args=(ring.name, 1))]
+            for process in [decoder] + consumers:
+                process.start()
+            with self.assertLogs(level="ERROR") as logs:
+                supervise(ring, decoder, consumers)
+
+            self.assertEqual(decoder.exitcode, 0)
+            self.assertEqual(consumers[0].exitcode, 0)
+            self.assertEqual(consumers[1].exitcode, -signal.SIGKILL)
+            self.assertEqual(logs.output, [f"ERROR:root:Detector 1 process exited with code {-signal.SIGKILL}"])
+        finally:
+            ring.release()
+
+    def test_supervise_closes_ring_when_decoder_is_killed(self):
+        decoder = Process(target=signal.pause)
+        consumer = Process(target=read_all, args=(self.ring.name, 0))
+        decoder.start()
+        consumer.start()
+        decoder.kill()
+        supervise(self.ring, decoder, [consumer])
+
+        self.assertEqual(consumer.exitcode, 0)
+
+    def test_fan_out_raises_when_decoder_fails(self):
+        directory = tempfile.mkdtemp()
+        video = os.path.join(directory, "video.avi")
+        write_video(video, 5)
+
+        with mock.patch("frame_ring.publish_video", fail_to_decode), \
+                mock.patch("motion_detector.open_cv.destroyAllWindows"), self.assertLogs(level="ERROR"):
+            with self.assertRaises(RuntimeError):
+                fan_out(video, 1, [[]], ["empty"])
+
+
+class BoxGridTest(unittest.TestCase):
+
+    @staticmethod
+    def overlapping(boxes, box):
+        x, y, width, height = box
+        return {key for key, (bx, by, bw, bh) in boxes.items()
+                if bx < x + width and x < bx + bw and by < y + height and y < by + bh}
+
+    def test_query_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        grid = BoxGrid(cell_size=32)
+        boxes = {}
+        # Boxes start left of and above the origin and span several cells, like spaces with their margin
+        for key in range(200):
+            box = tuple(int(v) for v in (*rng.integers(-100, 500, 2), *rng.integers(1, 120, 2)))
+            grid.add(key, box)
+            boxes[key] = box
+        for key in range(0, 200, 3):
+            grid.remove(key)
+            del boxes[key]
+
+        for _ in range(300):
+            box = tuple(int(v) for v in (*rng.integers(-150, 550, 2), *rng.integers(1, 80, 2)))
+            self.assertEqual(grid.query(box), self.overlapping(boxes, box))
+            self.assertEqual(grid.at(box[0], box[1]), self.overlapping(boxes, (box[0], box[1], 1, 1)))
+
+    def test_remove_drops_empty_cells(self):
+        grid = BoxGrid(cell_size=10)
+        grid.add("a", (-15, -5, 30, 10))
+        self.assertEqual(grid.at(-15, -5), {"a"})
+        self.assertEqual(grid.at(14, 4), {"a"})
+        self.assertEqual(grid.at(15, 4), set())
+        grid.remove("a")
+        self.assertEqual(grid.cells, {})
+
+
+@mock.patch("coordinates_generator.open_cv.imshow")
+@mock.patch("coordinates_generator.open_cv.setMouseCallback")
+@mock.patch("coordinates_generator.open_cv.namedWindow")
+class CoordinatesGeneratorTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.image = os.path.join(directory, "lot.png")
+        open_cv.imwrite(self.image, np.zeros((100, 200, 3), dtype=np.uint8))
+        self.output = os.path.join(directory, "coordinates.yml")
+        # Baseline format, with optional zone and level tags
+        with open(self.output, "w") as data:
+            data.write("-\n"
+                       "          id: 0\n"
+                       "          coordinates: [[10,10],[50,10],[50,40],[10,40]]\n"
+                       "          zone: A\n"
+                       "-\n"
+                       "          id: 3\n"
+                       "          coordinates: [[100,20],[140,20],[140,60],[100,60]]\n"
+                       "          level: 2\n")
+
+    def click(self, generator, event, x, y):
+        generator._CoordinatesGenerator__mouse_callback(event, x, y, 0, None)
+
+    def test_load_and_save_keep_ids_and_tags(self, *_):
+        generator = CoordinatesGenerator(self.image, self.output, (0, 0, 255))
+        generator.save()
+        with open(self.output, "r") as data:
+            spaces = yaml.safe_load(data)
+        self.assertEqual([p["id"] for p in spaces], [0, 3])
+        self.assertEqual(spaces[0]["zone"], "A")
+        self.assertEqual(spaces[1]["level"], 2)
+        self.assertEqual(spaces[1]["coordinates"], [[100, 20], [140, 20], [140, 60], [100, 60]])
+
+    def test_hit_test(self, *_):
+        generator = CoordinatesGenerator(self.image, self.output, (0, 0, 255))
+        hit_test = generator._CoordinatesGenerator__hit_test
+        self.assertEqual(hit_test(20, 20), 0)
+        self.assertEqual(hit_test(140, 60), 3)
+        # Inside the bounding box margin but outside the space
+        self.assertIsNone(hit_test(55, 20))
+        self.assertIsNone(hit_test(80, 80))
+
+    def test_drag_is_clamped_to_the_image(self, *_):
+        generator = CoordinatesGenerator(self.image, self.output, (0, 0, 255))
+        generator.drawing_mode = "select"
+        self.click(generator, open_cv.EVENT_LBUTTONDOWN, 120, 40)
+        self.assertEqual(generator.selected, 3)
+        self.click(generator, open_cv.EVENT_LBUTTONUP, 250, -30)
+
+        self.assertEqual(generator.spaces[3]["coordinates"], [[159, 0], [199, 0], [199, 40], [159, 40]])
+        self.assertEqual(generator.boxes.at(180, 20), {3})
+        self.assertEqual(generator.boxes.at(120, 60), set())
+
+        self.click(generator, open_cv.EVENT_LBUTTONDOWN, 20, 20)
+        self.click(generator, open_cv.EVENT_LBUTTONUP, 25, 30)
+        self.assertEqual(generator.spaces[0]["coordinates"], [[15, 20], [55, 20], [55, 50], [15, 50]])
+
+
+class ParkingIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.coordinates = []
+        for space_id, (x, y) in enumerate(rng.integers(0, 2000, (500, 2))):
+            self.coordinates.append({"id": space_id, "zone": "AB"[space_id % 2],
+                                     "coordinates": [[x, y], [x + 20, y], [x + 20, y + 40], [x, y + 40]]})
+        self.index = ParkingIndex(self.coordinates, entrances={"north": (1000, 0)})
+        for space in rng.choice(500, 400, replace=False):
+            self.index.set_status(int(space), True)
+        self.points = rng.uniform(-200, 2200, (100, 2))
+
+    def brute_force(self, point, count, zone=None):
+        distances = []
+        for index, p in enumerate(self.coordinates):
+            if not self.index.statuses[index] and (zone is None or p["zone"] == zone):
+                distance = np.hypot(*(self.index.centroids[index] - point))
+                distances.append((distance, p["id"]))
+        return sorted(distances)[:count]
+
+    def assertSameNearest(self, found, expected):
+        self.assertEqual(len(found), len(expected))
+        np.testing.assert_allclose([d for d, _ in found], [d for d, _ in expected])
+
+    def test_nearest_vacant_matches_brute_force(self):
+        for point in self.points:
+            for count in (1, 5, 150):
+                self.assertSameNearest(self.index.nearest_vacant(tuple(point), count),
+                                       self.brute_force(point, count))
+            self.assertSameNearest(self.index.nearest_vacant(tuple(point), 3, zone="B"),
+                                   self.brute_force(point, 3, zone="B"))
+
+    def test_nearest_vacant_to_entrance(self):
+        self.assertSameNearest(self.index.nearest_vacant("north", 2), self.brute_force((1000, 0), 2))
+        with self.assertRaises(KeyError):
+            self.index.nearest_vacant("south")
+
+    def test_nearest_vacant_with_zero_count(self):
+        self.assertEqual(self.index.nearest_vacant((0, 0), 0), [])
+
+    def test_zone_counts_follow_status_changes(self):
+        counts = self.index.group_counts("zone")
+        self.assertEqual(sum(vacant for vacant, _ in counts.values()), self.index.vacant)
+        self.assertEqual(sum(occupied for _, occupied in counts.values()), self.index.occupied)
+
+
+class OccupancyHistoryTest(unittest.TestCase):
+    START = 1700000000.0
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.coordinates = [{"id": space_id, "coordinates": [[x, 0], [x + 20, 0], [x + 20, 40], [x, 40]]}
+                            for space_id, x in enumerate(range(0, 100, 25))]
+        self.ids = [p["id"] for p in self.coordinates]
+        store = OccupancyStore(self.path, self.ids)
+        store.record(self.START, 0, True)
+        store.record(self.START + 60, 2, True)
+        store.record(self.START + 90, 0, False)
+        store.record(self.START + 120, 3, True)
+        store.close()
+
+    def restart(self):
+        return MotionDetector("video.mp4", self.coordinates, 1, history_path=self.path, stabilize=False)
+
+    def test_restart_keeps_stored_statuses(self):
+        end = self.START + 3600
+        store = OccupancyStore(self.path, self.ids)
+        turnover, dwell = store.turnover(self.START, end), store.dwell_times(self.START, end)
+
+        with mock.patch("motion_detector.time.time", return_value=self.START + 600), \
+                mock.patch("motion_detector.open_cv.destroyAllWindows"):
+            detector = self.restart()
+            detector.source = iter([])
+            detector.detect_motion()
+        self.assertEqual(detector.index.statuses, [False, False, True, True])
+        self.assertEqual(detector.index.occupied, 2)
+
+        store = OccupancyStore(self.path, self.ids)
+        np.testing.assert_array_equal(store.turnover(self.START, end), turnover)
+        np.testing.assert_array_equal(store.dwell_times(self.START, end), dwell)
+
+    def test_clock_going_back_is_clamped(self):
+        detector = self.restart()
+        with mock.patch("motion_detector.time.time", return_value=self.START + 30):
+            detector._record_history(1, True)
+        detector.history.close()
+
+        store = OccupancyStore(self.path, self.ids)
+        self.assertEqual(store.last_time, self.START + 120)
+        self.assertTrue(store.occupancy_at(self.START + 120)[1])
+
+    def test_partly_written_record_is_dropped_on_reopen(self):
+        chunk = [name for name in os.listdir(self.path) if name.endswith(".events")][0]
+        with open(os.path.join(self.path, chunk), "ab") as events:
+            events.write(b"\x01\x02\x03")
+        store = OccupancyStore(self.path, self.ids)
+        store.record(self.START + 200, 1, True)
+        store.record(self.START + 300, 3, False)
+        store.close()
+
+        store = OccupancyStore(self.path, self.ids)
+        np.testing.assert_array_equal(store.statuses, [False, True, True, False])
+        self.assertEqual(store.last_time, self.START + 300)
+        np.testing.assert_array_equal(store.turnover(self.START - 1, self.START + 400), [1, 1, 1, 1])
+
+    def test_reopen_with_other_space_ids_fails(self):
+        # Same number of spaces, but space 1 was deleted and space 7 added
+        with self.assertRaises(ValueError):
+            OccupancyStore(self.path, [0, 2, 3, 7])
+
+    def test_hourly_profile_follows_daylight_saving(self):
+        timezone = os.environ.get("TZ")
+        os.environ["TZ"] = "Europe/Berlin"
+        time.tzset()
+        try:
+            store = OccupancyStore(tempfile.mkdtemp(), [0])
+            # Occupied from 10:00 to 11:00 local time every day around the change to summer time on March 31
+            for day in range(25, 36):
+                arrival = time.mktime((2024, 3, day, 10, 0, 0, 0, 0, -1))
+                store.record(arrival, 0, True)
+                store.record(arrival + 3600, 0, False)
+            profile = store.hourly_profile(time.mktime((2024, 3, 25, 0, 0, 0, 0, 0, -1)),
+                                           time.mktime((2024, 3, 36, 0, 0, 0, 0, 0, -1)))
+        finally:
+            if timezone is None:
+                del os.environ["TZ"]
+            else:
+                os.environ["TZ"] = timezone
+            time.tzset()
+
+        np.testing.assert_allclose(profile[10], 1.0)
+        np.testing.assert_allclose(np.delete(profile, 10), 0.0)
+
+
+def balanced_accuracy(scores, occupied, threshold):
+    predicted = scores > threshold
+    return ((predicted & occupied).sum() / occupied.sum() + (~predicted & ~occupied).sum() / (~occupied).sum()) / 2
+
+
+def brute_force_cut(scores, occupied):
+    """Best balanced accuracy over every threshold between, below and above the distinct scores"""
+    values = np.unique(scores)
+    thresholds = np.concatenate([[values[0] - 1], (values[1:] + values[:-1]) / 2, [values[-1] + 1]])
+    return max(balanced_accuracy(scores, occupied, threshold) for threshold in thresholds)
+
+
+class CalibrationTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        frames, spaces = 30, 6
+        self.occupied = rng.random((frames, spaces)) < 0.4
+        # Occupied spaces have more edges and differ more from the reference, with plenty of overlap
+        motion = rng.normal(0.5, 0.4, (frames, spaces)) + self.occupied
+        diff = rng.random((frames, spaces, len(calibration.DIFF_THRESHOLDS))) * 0.2
+        diff += self.occupied[..., None] * np.linspace(0.3, 0.0, len(calibration.DIFF_THRESHOLDS))
+        self.features = {"space_ids": np.arange(spaces) + 10, "motion": motion.astype(np.float32),
+                         "diff": diff.astype(np.float32)}
+        frame, space = np.meshgrid(np.arange(frames), np.arange(spaces), indexing="ij")
+        self.samples = (frame.ravel(), space.ravel(), self.occupied.ravel())
+
+    def test_best_cuts_matches_brute_force(self):
+        rng = np.random.default_rng(1)
+        occupied = rng.random(40) < 0.5
+        # Rounded scores make ties between occupied and vacant samples likely
+        scores = np.round(rng.normal(size=(50, 40)) + occupied, 1)
+        accuracy, cuts = calibration.best_cuts(scores, occupied)
+        for row, best, cut in zip(scores, accuracy, cuts):
+            self.assertAlmostEqual(best, brute_force_cut(row, occupied))
+            self.assertAlmostEqual(balanced_accuracy(row, occupied, cut), best)
+
+    def test_sweep_matches_brute_force(self):
+        frames, spaces, occupied = self.samples
+        motion = self.features["motion"][frames, spaces].astype(np.float64)
+        diff = self.features["diff"][frames, spaces].astype(np.float64)
+        expected = max(brute_force_cut(motion_weight * motion + diff_weight * diff[:, t], occupied)
+                       for t in range(len(calibration.DIFF_THRESHOLDS))
+                       for motion_weight in calibration.MOTION_WEIGHTS
+                       for diff_weight in calibration.DIFF_WEIGHTS)
+
+        result = calibration.sweep(self.features, self.samples, per_space=True)
+        self.assertAlmostEqual(result["balanced_accuracy"], round(expected, 4))
+
+        t = list(calibration.DIFF_THRESHOLDS).index(result["diff_threshold"])
+        scores = result["motion_weight"] * motion + result["diff_weight"] * diff[:, t]
+        self.assertAlmostEqual(balanced_accuracy(scores, occupied, result["sensitivity"]), expected, places=3)
+        self.assertEqual(sorted(result["spaces"]), list(self.features["space_ids"]))
+
+    def test_feature_cache_is_invalidated_by_a_moved_space(self):
+        directory = tempfile.mkdtemp()
+        video = os.path.join(directory, "video.avi")
+        write_video(video, MotionDetector.SKIP_FRAMES + 12, size=(96, 64))
+        cache = os.path.join(directory, "features.npz")
+        coordinates = [{"id": 0, "coordinates": [[5, 5], [30, 5], [30, 30], [5, 30]]},
+                       {"id": 1, "coordinates": [[40, 5], [70, 5], [70, 40], [40, 40]]}]
+
+        features = calibration.extract_features(video, coordinates, 1, 5)
+        calibration.save_features(cache, features)
+        self.assertIsNotNone(calibration.load_features(cache, video, coordinates, 1, 5))
+
+        moved = [dict(p) for p in coordinates]
+        moved[1]["coordinates"] = [[x + 10, y + 10] for x, y in coordinates[1]["coordinates"]]
+        self.assertIsNone(calibration.load_features(cache, video, moved, 1, 5))
+        self.assertIsNone(calibration.load_features(cache, video, coordinates, 1, 5, stabilize=False))
+        with mock.patch.object(MotionDetector, "SKIP_FRAMES", MotionDetector.SKIP_FRAMES + 1):
+            self.assertIsNone(calibration.load_features(cache, video, coordinates, 1, 5))
+
+    def test_sweep_needs_both_classes(self):
+        frames, spaces, occupied = self.samples
+        for labels in (np.ones_like(occupied), np.zeros_like(occupied)):
+            with self.assertRaises(ValueError):
+                calibration.sweep(self.features, (frames, spaces, labels))
+
+
+def textured_frame(width, height, seed=0):
+    """Grayed frame with blobs at several scales, like a parking lot seen from a pole"""
+    rng = np.random.default_rng(seed)
+    frame = np.zeros((height, width), dtype=np.float32)
+    for cell in (8, 32, 128):
+        noise = rng.random((height // cell + 1, width // cell + 1)).astype(np.float32)
+        frame += open_cv.resize(noise, (width, height), interpolation=open_cv.INTER_CUBIC)
+    return open_cv.normalize(frame, None, 0, 255, open_cv.NORM_MINMAX).astype(np.uint8)
+
+
+def shifted(grayed, dx, dy):
+    matrix = np.float32([[1, 0, dx], [0, 1, dy]])
+    return open_cv.warpAffine(grayed, matrix, grayed.shape[::-1], borderMode=open_cv.BORDER_REPLICATE)
+
+
+class CameraStabilizerTest(unittest.TestCase):
+
+    def test_estimates_known_shift(self):
+        # 320x240 is estimated at full resolution, larger frames are downscaled and refined on a patch
+        for width, height, refined in ((320, 240, False), (640, 480, True), (1920, 1080, True)):
+            reference = textured_frame(width, height)
+            for dx, dy in ((3, -2), (-7, 5), (0, 6)):
+                stabilizer = CameraStabilizer(update_every=1)
+                stabilizer.set_reference(reference)
+                self.assertEqual(stabilizer.patch is not None, refined)
+                self.assertEqual(stabilizer.update(shifted(reference, dx, dy)), (dx, dy), f"{width}x{height}")
+
+    def test_estimates_only_every_update_every_frames(self):
+        reference = textured_frame(640, 480)
+        stabilizer = CameraStabilizer(update_every=3)
+        self.assertEqual(stabilizer.update(reference), (0, 0))
+
+        moved = shifted(reference, 4, -3)
+        with mock.patch("stabilizer.open_cv.phaseCorrelate", wraps=open_cv.phaseCorrelate) as correlate:
+            self.assertEqual(stabilizer.update(moved), (0, 0))
+            self.assertEqual(stabilizer.update(moved), (0, 0))
+            self.assertEqual(correlate.call_count, 0)
+            self.assertEqual(stabilizer.update(moved), (4, -3))
+            calls = correlate.call_count
+            self.assertEqual(stabilizer.update(reference), (4, -3))
+            self.assertEqual(correlate.call_count, calls)
+
+    def test_keeps_last_shift_on_weak_response(self):
+        reference = textured_frame(640, 480)
+        stabilizer = CameraStabilizer(update_every=1)
+        stabilizer.set_reference(reference)
+        self.assertEqual(stabilizer.update(shifted(reference, 2, 1)), (2, 1))
+
+        weak = ((30.0, 30.0), CameraStabilizer.MIN_RESPONSE / 2)
+        with mock.patch("stabilizer.open_cv.phaseCorrelate", return_value=weak):
+            self.assertEqual(stabilizer.update(reference), (2, 1))
+
+
+class MotionDetectorRoiTest(unittest.TestCase):
+
+    def setUp(self):
+        # One space in the middle and one touching the right edge of a 100x80 frame
+        coordinates = [{"id": 0, "coordinates": [[40, 30], [59, 30], [59, 49], [40, 49]]},
+                       {"id": 1, "coordinates": [[80, 10], [99, 10], [99, 29], [80, 29]]}]
+        self.detector = MotionDetector("video.mp4", coordinates, 1, stabilize=False)
+        self.detector._prepare_spaces()
+        self.grayed = np.arange(80 * 100, dtype=np.int32).reshape(80, 100)
+
+    def test_roi_follows_the_shift(self):
+        self.detector.shift = (5, -4)
+        np.testing.assert_array_equal(self.detector._roi(self.grayed, 0), self.grayed[26:46, 45:65])
+
+    def test_roi_is_clamped_at_the_frame_edge(self):
+        self.detector.shift = (6, -15)
+        # x cannot move right at all, y stops at the top edge
+        self.assertEqual(self.detector._space_shift(1, self.grayed.shape), (0, -10))
+        np.testing.assert_array_equal(self.detector._roi(self.grayed, 1), self.grayed[0:20, 80:100])
+
+        self.detector.shift = (-6, 3)
+        self.assertEqual(self.detector._space_shift(1, self.grayed.shape), (-6, 3))
+        self.assertEqual(self.detector._roi(self.grayed, 1).shape, (20, 20))
+
+    def test_space_past_the_edge_is_not_moved_without_shift(self):
+        self.detector.bounds[1] = (90, 10, 20, 20)
+        self.detector.shift = (0, 0)
+        self.assertEqual(self.detector._space_shift(1, self.grayed.shape), (0, 0))
+        self.detector.shift = (4, 0)
+        self.assertEqual(self.detector._space_shift(1, self.grayed.shape), (0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
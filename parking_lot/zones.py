@@ -0,0 +1,161 @@
+import cv2 as open_cv
+import heapq
+import math
+import numpy as np
+
+
+class SpaceGrid:
+    """Uniform grid over parking space centroids, holding the spaces that are currently vacant"""
+    SPACES_PER_CELL = 2  # Average number of spaces per cell the grid is sized for
+
+    def __init__(self, centroids):
+        self.centroids = centroids.tolist()
+        low = centroids.min(axis=0) if len(centroids) else np.zeros(2)
+        high = centroids.max(axis=0) if len(centroids) else np.zeros(2)
+        area = max(float(np.prod(high - low)), 1.0)
+        self.cell_size = max(math.sqrt(area * self.SPACES_PER_CELL / max(len(centroids), 1)), 1.0)
+        self.origin = low.tolist()
+        self.extent = tuple(int(v) for v in (high - low) // self.cell_size)
+        self.cells = {}  # (column, row) -> set of space indices
+
+    def _cell(self, point):
+        return (math.floor((point[0] - self.origin[0]) / self.cell_size),
+                math.floor((point[1] - self.origin[1]) / self.cell_size))
+
+    def add(self, index):
+        self.cells.setdefault(self._cell(self.centroids[index]), set()).add(index)
+
+    def discard(self, index):
+        cell = self._cell(self.centroids[index])
+        members = self.cells.get(cell)
+        if members is not None:
+            members.discard(index)
+            if not members:
+                del self.cells[cell]
+
+    def __len__(self):
+        return sum(len(members) for members in self.cells.values())
+
+    def nearest(self, point, count=1):
+        """Return up to count (distance, index) pairs closest to point, searching rings of cells outwards"""
+        if count <= 0:
+            return []
+        column, row = self._cell(point)
+        x, y = point
+        best = []  # Max-heap of (-distance, index) holding the closest spaces found so far
+
+        def visit(members):
+            for index in members:
+                cx, cy = self.centroids[index]
+                distance = math.hypot(cx - x, cy - y)
+                if len(best) < count:
+                    heapq.heappush(best, (-distance, index))
+                elif distance < -best[0][0]:
+                    heapq.heapreplace(best, (-distance, index))
+
+        max_ring = max(abs(column), abs(self.extent[0] - column), abs(row), abs(self.extent[1] - row))
+        for ring in range(max_ring + 1):
+            # Once a ring has more cells than are populated, scanning what is left is cheaper
+            if 8 * ring > len(self.cells):
+                for (c, r), members in self.cells.items():
+                    if max(abs(c - column), abs(r - row)) >= ring:
+                        visit(members)
+                break
+
+            for c in range(column - ring, column + ring + 1):
+                for r in (row - ring, row + ring) if ring else (row,):
+                    visit(self.cells.get((c, r), ()))
+            for r in range(row - ring + 1, row + ring):
+                for c in (column - ring, column + ring):
+                    visit(self.cells.get((c, r), ()))
+
+            # Any space outside this ring is at least ring * cell_size away
+            if len(best) == count and -best[0][0] <= ring * self.cell_size:
+                break
+
+        return sorted((-distance, index) for distance, index in best)
+
+
+class ParkingIndex:
+    """Per-zone occupancy counters and nearest-vacant-space lookups over the parking spaces.
+
+    Spaces may carry optional "zone" and "level" tags in the coordinates file.
+    Counters and the spatial index are updated incrementally whenever a space
+    commits a new status, so reading them costs nothing per frame.
+    """
+    GROUP_KEYS = ("zone", "level")
+
+    def __init__(self, coordinates_data, entrances=None):
+        self.ids = [p["id"] for p in coordinates_data]
+        self.centroids = np.array([self._centroid(p) for p in coordinates_data], dtype=np.float64).reshape(-1, 2)
+        self.groups = [tuple((key, p[key]) for key in self.GROUP_KEYS if key in p) for p in coordinates_data]
+        self.entrances = entrances or {}
+
+        self.statuses = [False] * len(coordinates_data)  # False = vacant, True = occupied
+        self.occupied = 0
+        self.counts = {}  # (key, value) -> [vacant, occupied]
+        self.grids = {None: SpaceGrid(self.centroids)}  # None indexes the whole lot
+
+        for index, groups in enumerate(self.groups):
+            self.grids[None].add(index)
+            for group in groups:
+                self.counts.setdefault(group, [0, 0])[0] += 1
+                if group not in self.grids:
+                    self.grids[group] = SpaceGrid(self.centroids)
+                self.grids[group].add(index)
+
+    @property
+    def vacant(self):
+        return len(self.statuses) - self.occupied
+
+    def set_status(self, index, status):
+        """Commit a new status for a space, updating the counters and the vacant-space index"""
+        if self.statuses[index] == status:
+            return
+        self.statuses[index] = status
+        self.occupied += 1 if status else -1
+
+        for group in (None,) + self.groups[index]:
+            if group is not None:
+                counts = self.counts[group]
+                counts[0] -= 1 if status else -1
+                counts[1] += 1 if status else -1
+            if status:
+                self.grids[group].discard(index)
+            else:
+                self.grids[group].add(index)
+
+    def group_counts(self, key):
+        """Return {value: (vacant, occupied)} for every value of the given tag, e.g. "zone" """
+        return {value: tuple(counts) for (group_key, value), counts in self.counts.items() if group_key == key}
+
+    def nearest_vacant(self, point, count=1, zone=None, level=None):
+        """Return up to count (distance, space id) pairs of vacant spaces closest to point.
+
+        point is either an (x, y) pixel position or the name of an entrance.
+        The search can be limited to one zone or one level.
+        """
+        if zone is not None and level is not None:
+            raise ValueError("Filter nearest vacant spaces by either zone or level, not both")
+        if isinstance(point, str):
+            if point not in self.entrances:
+                raise KeyError(f"Unknown entrance '{point}'")
+            point = self.entrances[point]
+
+        group = None
+        if zone is not None:
+            group = ("zone", zone)
+        elif level is not None:
+            group = ("level", level)
+        grid = self.grids.get(group)
+        if grid is None:
+            return []
+        return [(distance, self.ids[index]) for distance, index in grid.nearest(point, count)]
+
+    @staticmethod
+    def _centroid(p):
+        coordinates = np.array(p["coordinates"])
+        moments = open_cv.moments(coordinates)
+        if moments["m00"] == 0:
+            return coordinates.mean(axis=0)
+        return moments["m10"] / moments["m00"], moments["m01"] / moments["m00"]